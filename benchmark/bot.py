@@ -0,0 +1,148 @@
+# Threads and memory for N concurrent "/run all" jobs, before and after the
+# asyncio port of checkin-bot.py, against benchmark.mockserver.
+# Usage: python -m benchmark.bot [--accounts 500] [--latency 0.05] [--captchas data/test]
+import argparse
+import json
+import os
+import subprocess
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from benchmark.mockserver import MockServer
+from utils.utils import logger
+
+MODES = ("threads", "asyncio")
+
+
+def status(key):
+    # Linux only: counts native threads (torch, uvloop, ...) too.
+    with open("/proc/self/status") as file:
+        for line in file:
+            if line.startswith(key + ":"):
+                return int(line.split()[1])
+
+
+class Peak(threading.Thread):
+    def __init__(self, interval=0.005):
+        super().__init__(daemon=True)
+        self.interval = interval
+        self.threads = 0
+        self.running = True
+
+    def run(self):
+        while self.running:
+            self.threads = max(self.threads, status("Threads"))
+            time.sleep(self.interval)
+
+
+def run_threads(users, predictor):
+    """The bot before the port: one blocking requests job per thread."""
+    import requests
+    from PIL import Image
+
+    from utils.pages import checked_in, find_execution
+
+    dk_url = os.environ["DK_URL"]
+    captcha_url = os.environ["CAS_URL"] + "captcha"
+
+    def job(config):
+        s = requests.Session()
+        for _ in range(5):
+            try:
+                home = s.get(dk_url, timeout=10)
+                captcha = s.get(captcha_url, stream=True, timeout=10)
+                data = {
+                    "username": config["USERNAME"],
+                    "password": config["PASSWORD"],
+                    "validateCode": predictor.detect(Image.open(captcha.raw)).label,
+                    "execution": find_execution(home.content),
+                    "_eventId": "submit",
+                    "geolocation": "",
+                }
+                if s.post(home.url, data=data, timeout=10).url == dk_url:
+                    break
+            except requests.RequestException:
+                continue
+        for _ in range(5):
+            try:
+                s.post(dk_url + "checkin", data={"xgh": config["USERNAME"]}, timeout=10)
+                if checked_in(s.get(dk_url, timeout=10).content):
+                    return True
+            except requests.RequestException:
+                continue
+        return False
+
+    with ThreadPoolExecutor(len(users)) as executor:
+        return sum(executor.map(job, users))
+
+
+def measure(mode, url, accounts, concurrency, rate):
+    os.environ["DK_URL"] = url
+    os.environ["CAS_URL"] = url + "cas/"
+    from benchmark.load import accounts as make_accounts
+    from benchmark.load import run_bot
+    from inference import BatchPredictor, load_model
+
+    predictor = BatchPredictor(load_model(), min_confidence=0)
+    users = make_accounts(accounts)
+    baseline_rss, baseline_threads = status("VmRSS"), status("Threads")
+    peak = Peak()
+    peak.start()
+    start = time.perf_counter()
+    if mode == "threads":
+        succeeded = run_threads(users, predictor)
+    else:
+        succeeded = run_bot(users, predictor, None, concurrency, rate)
+    elapsed = time.perf_counter() - start
+    peak.running = False
+    return {
+        "mode": mode,
+        "succeeded": succeeded,
+        "accounts": accounts,
+        "seconds": elapsed,
+        "threads": baseline_threads,
+        "peak_threads": peak.threads,
+        "rss_mb": baseline_rss / 1024,
+        "peak_rss_mb": status("VmHWM") / 1024,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("modes", nargs="*", default=list(MODES))
+    parser.add_argument("--accounts", type=int, default=500)
+    parser.add_argument("--latency", type=float, default=0.05)
+    parser.add_argument("--captchas", default="data/test")
+    parser.add_argument("--concurrency", type=int, default=32)
+    parser.add_argument("--rate", type=float, default=1000, help="requests/s")
+    parser.add_argument("--child", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    options = [args.accounts, args.concurrency, args.rate]
+    if args.child:
+        print(json.dumps(measure(args.modes[0], args.child, *options)))
+        return
+    # The server's own threads stay out of the measured processes, and one
+    # process per mode keeps peak RSS from including the previous mode.
+    server = MockServer(("127.0.0.1", 0), args.captchas, args.latency).start()
+    for mode in args.modes:
+        output = subprocess.run(
+            [sys.executable, "-m", "benchmark.bot", mode, "--child", server.url]
+            + ["--accounts", str(args.accounts)]
+            + ["--concurrency", str(args.concurrency), "--rate", str(args.rate)],
+            check=True,
+            capture_output=True,
+            text=True,
+        ).stdout
+        result = json.loads(output.splitlines()[-1])
+        logger.info(
+            f"Benchmark: {result['mode']}: {result['succeeded']}/{result['accounts']} "
+            f"jobs in {result['seconds']:.2f}s, threads {result['threads']} -> "
+            f"{result['peak_threads']}, RSS {result['rss_mb']:.1f}MB -> "
+            f"{result['peak_rss_mb']:.1f}MB"
+        )
+
+
+if __name__ == "__main__":
+    main()
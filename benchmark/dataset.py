@@ -0,0 +1,48 @@
+# Compare the folder loader with the packed memmap loader in images/sec.
+# Usage: python pack.py && python -m benchmark.dataset [--folder data/train]
+import argparse
+import time
+
+from torch.utils.data import DataLoader
+
+from dataset import get_data_loader, selfdataset
+from utils.utils import logger
+
+
+def throughput(loader, epochs):
+    images = 0
+    start = time.perf_counter()
+    for _ in range(epochs):
+        for batch, _ in loader:
+            images += batch.size(0)
+    return images / (time.perf_counter() - start)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--folder", default="data/train")
+    parser.add_argument("--batch-size", type=int, default=64)
+    parser.add_argument("--workers", type=int, default=8)
+    parser.add_argument("--epochs", type=int, default=2)
+    args = parser.parse_args()
+
+    loaders = {
+        "folder": DataLoader(
+            selfdataset(args.folder),
+            batch_size=args.batch_size,
+            shuffle=True,
+            num_workers=args.workers,
+        ),
+        "packed": get_data_loader(
+            args.folder, args.batch_size, shuffle=True, num_workers=args.workers
+        ),
+    }
+    for name, loader in loaders.items():
+        logger.info(
+            f"Benchmark: {name} loader ({type(loader.dataset).__name__}): "
+            f"{throughput(loader, args.epochs):.0f} images/sec"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,90 @@
+# Training throughput of DistributedDataParallel at 1, 2, 4 and 8 processes on
+# this machine, on synthetic batches so the data loader is not measured.
+# Usage: python -m benchmark.ddp [--processes 1 2 4 8] [--steps 20]
+import argparse
+import json
+import subprocess
+import sys
+import time
+
+import torch
+import torch.distributed as dist
+from torch.nn.parallel import DistributedDataParallel
+
+from dataset import normalize
+from model import ResidualBlock, ResNet
+from train import setup_distributed
+from utils.utils import device, logger
+
+
+def worker(steps, batch_size, warmup=3):
+    rank, world_size = setup_distributed()
+    model = ResNet(ResidualBlock).to(device)
+    forward = model
+    if world_size > 1:
+        forward = DistributedDataParallel(
+            model, device_ids=[device.index] if device.type == "cuda" else None
+        )
+    criterion = torch.nn.CrossEntropyLoss()
+    optimizer = torch.optim.Adam(model.parameters())
+    images = torch.randint(0, 256, (batch_size, 3, 70, 200), dtype=torch.uint8)
+    images = normalize(images.to(device))
+    labels = torch.randint(0, 10, (batch_size, 2), device=device)
+    for step in range(warmup + steps):
+        if step == warmup:
+            if world_size > 1:
+                dist.barrier()
+            start = time.perf_counter()
+        optimizer.zero_grad()
+        y1, y2 = forward(images)
+        loss = criterion(y1, labels[:, 0]) + criterion(y2, labels[:, 1])
+        loss.backward()
+        optimizer.step()
+    if device.type == "cuda":
+        torch.cuda.synchronize()
+    elapsed = time.perf_counter() - start
+    if rank == 0:
+        print(
+            json.dumps(
+                {
+                    "processes": world_size,
+                    "threads": torch.get_num_threads(),
+                    "samples_per_sec": steps * batch_size * world_size / elapsed,
+                }
+            )
+        )
+    if world_size > 1:
+        dist.destroy_process_group()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--processes", type=int, nargs="+", default=[1, 2, 4, 8])
+    parser.add_argument("--steps", type=int, default=20)
+    parser.add_argument("--batch-size", type=int, default=64, help="per process")
+    parser.add_argument("--worker", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.worker:
+        worker(args.steps, args.batch_size)
+        return
+    baseline = None
+    for processes in args.processes:
+        output = subprocess.run(
+            [sys.executable, "-m", "torch.distributed.run", "--standalone"]
+            + [f"--nproc_per_node={processes}", "-m", "benchmark.ddp", "--worker"]
+            + ["--steps", str(args.steps), "--batch-size", str(args.batch_size)],
+            check=True,
+            capture_output=True,
+            text=True,
+        ).stdout
+        result = json.loads(output.splitlines()[-1])
+        baseline = baseline or result["samples_per_sec"] / processes
+        logger.info(
+            f"Benchmark: {processes} processes x {result['threads']} threads: "
+            f"{result['samples_per_sec']:.1f} samples/s, scaling efficiency "
+            f"{result['samples_per_sec'] / (baseline * processes):.0%}"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,81 @@
+# Compare startup time, per-captcha latency and peak RSS of the inference backends.
+# Usage: python -m benchmark.inference [--runs 200] [model/best.pkl model/best.ts onnx]
+# Models are paths or precisions (fp32, int8, channels_last, onnx) as in
+# config.json. ONNX models run without importing torch at all.
+import argparse
+import json
+import os
+import resource
+import subprocess
+import sys
+import time
+
+from inference import MODEL_PATH, ONNX_PATH, SCRIPT_PATH
+from utils.utils import logger
+
+
+def measure(path, runs, folder="data/test"):
+    # Everything a daemon imports before its first captcha counts as startup.
+    start = time.perf_counter()
+    from PIL import Image
+
+    from inference import PRECISIONS, load_model, predict, preprocess
+
+    if path in PRECISIONS:
+        model = load_model(precision=path)
+    else:
+        model = load_model(path)
+    files = sorted(os.listdir(folder))[:runs]
+    images = [preprocess(Image.open(os.path.join(folder, f)))[None] for f in files]
+    predict(model, images[0])  # warm up
+    startup = time.perf_counter() - start
+    latencies = []
+    for image in images:
+        start = time.perf_counter()
+        predict(model, image)
+        latencies.append(time.perf_counter() - start)
+    latencies.sort()
+    return {
+        "path": path,
+        "torch": "torch" in sys.modules,
+        "startup_s": startup,
+        "runs": len(latencies),
+        "mean_ms": 1000 * sum(latencies) / len(latencies),
+        "p50_ms": 1000 * latencies[len(latencies) // 2],
+        "p99_ms": 1000 * latencies[int(len(latencies) * 0.99)],
+        "peak_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "paths", nargs="*", default=[MODEL_PATH, SCRIPT_PATH, ONNX_PATH]
+    )
+    parser.add_argument("--runs", type=int, default=200)
+    parser.add_argument("--child", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.child:
+        print(json.dumps(measure(args.paths[0], args.runs)))
+        return
+    # One process per model, otherwise peak RSS would include the previous one.
+    for path in args.paths:
+        output = subprocess.run(
+            [sys.executable, "-m", "benchmark.inference", "--child", path]
+            + ["--runs", str(args.runs)],
+            check=True,
+            capture_output=True,
+            text=True,
+        ).stdout
+        result = json.loads(output.splitlines()[-1])
+        logger.info(
+            f"Benchmark: {result['path']}: startup {result['startup_s']:.2f}s "
+            f"({'with' if result['torch'] else 'without'} torch), "
+            f"{result['runs']} captchas, "
+            f"mean {result['mean_ms']:.2f}ms, p50 {result['p50_ms']:.2f}ms, "
+            f"p99 {result['p99_ms']:.2f}ms, peak RSS {result['peak_rss_mb']:.1f}MB"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,152 @@
+# Drive N simulated accounts through the daemons against benchmark.mockserver.
+# Usage: python -m benchmark.load [--accounts 100] [--target checkin bot] [--latency 0.05]
+# Sweep --min-confidence to tune the captcha refetch threshold. Rounds after the
+# first reuse the stored sessions, pass --rounds 1 for cold logins only.
+import argparse
+import asyncio
+import importlib
+import os
+import tempfile
+import time
+from types import SimpleNamespace
+
+from benchmark.mockserver import MockServer
+from inference import (
+    CACHE_TTL,
+    MAX_REFETCH,
+    MIN_CONFIDENCE,
+    BatchPredictor,
+    CaptchaCache,
+    load_model,
+)
+from utils.ratelimit import TokenBucket
+from utils.sessions import SessionStore
+from utils.store import AccountStore
+from utils.utils import logger
+
+
+def accounts(n):
+    return [
+        {"USERNAME": f"2017{i:08d}", "PASSWORD": "password", "REGION": 1}
+        for i in range(n)
+    ]
+
+
+def run_checkin(users, predictor, sessions, concurrency, rate):
+    checkin = importlib.import_module("checkin")
+    checkin.predictor = predictor
+    checkin.sessions = sessions
+    results = asyncio.run(checkin.run_users(users, concurrency, rate))
+    return sum(results)
+
+
+def run_bot(users, predictor, sessions, concurrency, rate):
+    checkin = importlib.import_module("checkin")
+    bot = importlib.import_module("checkin-bot")
+    checkin.predictor = predictor
+    checkin.sessions = sessions
+    bot.store = AccountStore(":memory:")
+
+    # Run the job outside of the telegram Application, with a stand-in context.
+    async def job(config):
+        sent = []
+
+        async def send_message(chat, text, **kwargs):
+            sent.append(text)
+
+        context = SimpleNamespace(
+            job=SimpleNamespace(
+                data={
+                    "username": config["USERNAME"],
+                    "password": config["PASSWORD"],
+                    "region": config["REGION"],
+                    "chat": 0,
+                }
+            ),
+            bot=SimpleNamespace(send_message=send_message),
+            job_queue=SimpleNamespace(
+                run_once=lambda *args, **kwargs: sent.append(None)
+            ),
+        )
+        await bot.checkin_queue(context)
+        return None not in sent
+
+    async def main():
+        bot.transport = checkin.make_transport(concurrency)
+        bot.bucket = TokenBucket(rate)
+        bot.semaphore = asyncio.Semaphore(concurrency)
+        try:
+            return sum(await asyncio.gather(*map(job, users)))
+        finally:
+            await bot.transport.aclose()
+
+    return asyncio.run(main())
+
+
+TARGETS = {"checkin": run_checkin, "bot": run_bot}
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--accounts", type=int, default=100)
+    parser.add_argument("--target", nargs="+", choices=TARGETS, default=list(TARGETS))
+    parser.add_argument("--concurrency", type=int, default=32)
+    parser.add_argument("--rate", type=float, default=1000, help="requests/s")
+    parser.add_argument("--latency", type=float, default=0.05)
+    parser.add_argument("--failure-rate", type=float, default=0.0)
+    parser.add_argument("--captchas", default="data/test")
+    parser.add_argument("--min-confidence", type=float, default=MIN_CONFIDENCE)
+    parser.add_argument("--max-refetch", type=int, default=MAX_REFETCH)
+    parser.add_argument("--rounds", type=int, default=2)
+    parser.add_argument("--cache-size", type=int, default=0, help="0: no cache")
+    parser.add_argument("--cache-ttl", type=float, default=CACHE_TTL)
+    args = parser.parse_args()
+
+    server = MockServer(
+        ("127.0.0.1", 0), args.captchas, args.latency, args.failure_rate
+    ).start()
+    # The daemons read these when they are imported.
+    os.environ["DK_URL"] = server.url
+    os.environ["CAS_URL"] = server.url + "cas/"
+    predictor = BatchPredictor(
+        load_model(),
+        min_confidence=args.min_confidence,
+        max_refetch=args.max_refetch,
+        cache=(
+            CaptchaCache(args.cache_size, args.cache_ttl) if args.cache_size else None
+        ),
+    )
+    users = accounts(args.accounts)
+    for target in args.target:
+        server.sessions.clear()
+        with tempfile.TemporaryDirectory() as folder:
+            sessions = SessionStore(folder)
+            for i in range(args.rounds):
+                server.stats.clear()
+                start = time.perf_counter()
+                succeeded = TARGETS[target](
+                    users, predictor, sessions, args.concurrency, args.rate
+                )
+                report(f"{target} round {i}", server.stats, succeeded, users, start)
+                if predictor.cache is not None:
+                    logger.info(f"Load: {predictor.cache.summary()}")
+
+
+def report(name, stats, succeeded, users, start):
+    elapsed = time.perf_counter() - start
+    captchas = stats["captcha_correct"] + stats["captcha_wrong"]
+    requests = sum(v for k, v in stats.items() if " /" in k)
+    logger.info(
+        f"Load: {name}: {succeeded}/{len(users)} accounts in {elapsed:.2f}s "
+        f"({len(users) / elapsed:.1f} accounts/s), "
+        f"captcha accuracy {100 * stats['captcha_correct'] / max(captchas, 1):.1f}%, "
+        f"logins {stats['logins']}, "
+        f"login retries {captchas - stats['logins']}, "
+        f"captcha refetches {stats['GET /cas/captcha'] - captchas}, "
+        f"injected failures {stats['injected_failures']}, "
+        f"requests {requests} ({requests / len(users):.1f} per account)"
+    )
+
+
+if __name__ == "__main__":
+    main()
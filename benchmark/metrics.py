@@ -0,0 +1,76 @@
+# Overhead of the instrumentation in utils.metrics, per call and per check-in job.
+# Usage: python -m benchmark.metrics [--repeat 100000] [--accounts 1000]
+import argparse
+import logging
+import time
+
+from utils import metrics
+from utils.metrics import Counter, Histogram, Registry, Stages
+from utils.utils import logger
+
+# Timed stages and counter updates of a cold login + check-in in checkin.py
+STAGES_PER_JOB = 8
+COUNTS_PER_JOB = 3
+
+
+def timeit(function, repeat):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        function()
+    return (time.perf_counter() - start) / repeat
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--repeat", type=int, default=100000)
+    parser.add_argument("--accounts", type=int, default=1000)
+    args = parser.parse_args()
+
+    registry = Registry()
+    histogram = Histogram("histogram", [0.01, 0.1, 1, 10], registry=registry)
+    counter = Counter("counter_total", "kind", registry=registry)
+    stages = Stages("stage_seconds", [0.01, 0.1, 1, 10], registry=registry)
+
+    def timed():
+        with stages.time("stage", username="201700000000"):
+            pass
+
+    baseline = timeit(lambda: None, args.repeat)
+    costs = {
+        "Histogram.observe": timeit(lambda: histogram.observe(0.5), args.repeat),
+        "Counter.inc": timeit(lambda: counter.inc("success"), args.repeat),
+        "Stages.time": timeit(timed, args.repeat),
+    }
+    # With JSON logs every stage is also a log record, formatted but discarded.
+    handler = logging.StreamHandler(open("/dev/null", "w"))
+    handler.setFormatter(metrics.JsonFormatter())
+    propagate, logger.propagate = logger.propagate, False
+    logger.addHandler(handler)
+    metrics.events = True
+    costs["Stages.time (JSON event)"] = timeit(timed, args.repeat // 10)
+    metrics.events = False
+    logger.removeHandler(handler)
+    logger.propagate = propagate
+    for name, cost in costs.items():
+        logger.info(f"Benchmark: {name}: {(cost - baseline) * 1e6:.2f}us per call")
+
+    job = STAGES_PER_JOB * costs["Stages.time"] + COUNTS_PER_JOB * costs["Counter.inc"]
+    logger.info(
+        f"Benchmark: ~{job * 1e6:.1f}us per check-in job, "
+        f"{job * args.accounts * 1e3:.2f}ms for {args.accounts} accounts"
+    )
+
+    # A scrape with as many stages as checkin.py and a few thousand samples.
+    for stage in range(10):
+        stages.observe(f"stage{stage}", 0.5)
+    for kind in range(10):
+        counter.inc(f"kind{kind}")
+    body = registry.expose()
+    logger.info(
+        f"Benchmark: /metrics body of {len(body)} bytes rendered in "
+        f"{timeit(registry.expose, 1000) * 1e6:.0f}us"
+    )
+
+
+if __name__ == "__main__":
+    main()
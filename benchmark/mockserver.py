@@ -0,0 +1,181 @@
+# Local stand-in for dk.shmtu.edu.cn and its CAS login, for load tests.
+# Usage: python -m benchmark.mockserver [--port 8080] [--latency 0.05] [--failure-rate 0.1]
+# then run a daemon with DK_URL=http://127.0.0.1:8080/ CAS_URL=http://127.0.0.1:8080/cas/
+import argparse
+import json
+import os
+import random
+import secrets
+import threading
+import time
+from collections import Counter
+from http.cookies import SimpleCookie
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+from utils.utils import logger
+
+LOGIN_PAGE = """<!DOCTYPE html>
+<html><head><title>CAS</title></head><body>
+<form id="fm1" method="post" action="/cas/login">
+<div class="form-group"><input id="username" name="username" type="text"></div>
+<div class="form-group"><input id="password" name="password" type="password"></div>
+<div class="form-group"><input id="validateCode" name="validateCode" type="text">
+<img src="/cas/captcha"></div>
+<input type="hidden" name="execution" value="{execution}">
+<input type="hidden" name="_eventId" value="submit">
+<input type="hidden" name="geolocation" value="">
+</form>
+{padding}
+</body></html>"""
+
+HOME_PAGE = """<!DOCTYPE html>
+<html><head><title>dk</title></head><body>
+<form method="post" action="/checkin">
+<div class="form-group">{status}</div>
+<div class="form-group"><select name="region"><option value="1">上海</option></select></div>
+</form>
+{padding}
+</body></html>"""
+
+# Real pages carry a few KB of scripts and navigation, pad to a similar size.
+PADDING = "\n".join(
+    f'<div class="nav"><a href="#{i}">item {i}</a></div>' for i in range(80)
+)
+
+
+class MockServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, captchas="data/test", latency=0.0, failure_rate=0.0):
+        super().__init__(address, MockHandler)
+        self.captchas = [
+            (name.split("_")[0], os.path.join(captchas, name))
+            for name in sorted(os.listdir(captchas))
+        ]
+        self.latency = latency
+        self.failure_rate = failure_rate
+        self.sessions = {}
+        self.stats = Counter()
+        self.lock = threading.Lock()
+
+    @property
+    def url(self):
+        return f"http://{self.server_address[0]}:{self.server_address[1]}/"
+
+    def count(self, key, n=1):
+        with self.lock:
+            self.stats[key] += n
+
+    def start(self):
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+
+class MockHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def session(self):
+        cookie = SimpleCookie(self.headers.get("Cookie", ""))
+        sid = cookie["SESSION"].value if "SESSION" in cookie else None
+        if sid not in self.server.sessions:
+            sid = secrets.token_hex(8)
+            self.server.sessions[sid] = {"id": sid, "new": True}
+        return self.server.sessions[sid]
+
+    def reply(
+        self, session, status=200, body=b"", content_type="text/html", location=None
+    ):
+        self.send_response(status)
+        if session.pop("new", False):
+            self.send_header("Set-Cookie", f"SESSION={session['id']}; Path=/")
+        if location:
+            self.send_header("Location", location)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def handle_one(self, method):
+        server = self.server
+        time.sleep(server.latency * random.uniform(0.5, 1.5))
+        session = self.session()
+        path = urlsplit(self.path).path
+        # Read the body even when failing, or it is parsed as the next request.
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        server.count(f"{method} {path}")
+        if random.random() < server.failure_rate:
+            server.count("injected_failures")
+            return self.reply(session, 502, b"Bad Gateway", "text/plain")
+        if method == "GET" and path == "/":
+            if not session.get("authenticated"):
+                return self.reply(session, 302, location="/cas/login?service=/")
+            status = "success" if session.get("checked_in") else "未打卡"
+            body = HOME_PAGE.format(status=status, padding=PADDING)
+            return self.reply(session, body=body.encode())
+        if method == "GET" and path == "/cas/login":
+            session["execution"] = secrets.token_hex(16)
+            body = LOGIN_PAGE.format(execution=session["execution"], padding=PADDING)
+            return self.reply(session, body=body.encode())
+        if method == "GET" and path == "/cas/captcha":
+            label, image = random.choice(server.captchas)
+            session["captcha"] = label
+            with open(image, "rb") as file:
+                return self.reply(session, body=file.read(), content_type="image/jpeg")
+        if method == "POST" and path == "/cas/login":
+            form = {k: v[0] for k, v in parse_qs(body.decode()).items()}
+            correct = form.get("validateCode") == session.pop("captcha", None)
+            server.count("captcha_correct" if correct else "captcha_wrong")
+            if correct and form.get("execution") == session.get("execution"):
+                session["authenticated"] = True
+                server.count("logins")
+                return self.reply(session, 302, location="/")
+            body = LOGIN_PAGE.format(
+                execution=session.get("execution"), padding=PADDING
+            )
+            return self.reply(session, body=body.encode())
+        if method == "POST" and path == "/checkin":
+            if not session.get("authenticated"):
+                return self.reply(session, 302, location="/cas/login?service=/")
+            session["checked_in"] = True
+            server.count("checkins")
+            return self.reply(
+                session, body=b'{"code": 0}', content_type="application/json"
+            )
+        if method == "GET" and path == "/stats":
+            return self.reply(
+                session,
+                body=json.dumps(server.stats).encode(),
+                content_type="application/json",
+            )
+        self.reply(session, 404, b"Not Found", "text/plain")
+
+    def do_GET(self):
+        self.handle_one("GET")
+
+    def do_POST(self):
+        self.handle_one("POST")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--captchas", default="data/test")
+    parser.add_argument(
+        "--latency", type=float, default=0.0, help="seconds per request"
+    )
+    parser.add_argument("--failure-rate", type=float, default=0.0, help="share of 502s")
+    args = parser.parse_args()
+    server = MockServer(
+        (args.host, args.port), args.captchas, args.latency, args.failure_rate
+    )
+    logger.info(f"Mock: Serving on {server.url}, stats at {server.url}stats")
+    server.serve_forever()
+
+
+if __name__ == "__main__":
+    main()
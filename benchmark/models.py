@@ -0,0 +1,81 @@
+# Parameters, FLOPs, CPU latency and test accuracy of every architecture in model.py.
+# Usage: python -m benchmark.models [resnet18 mobilenet ...] [--runs 50] [--test data/test]
+# Accuracy needs trained weights: model/best.pkl for resnet18 and
+# model/<arch>.best.pkl for the others (python train.py --arch <arch>).
+import argparse
+import os
+import time
+
+import torch
+from torch.utils.flop_counter import FlopCounterMode
+
+from evaluate import evaluate, get_evaluate_data_loader
+from export import EXAMPLE_SHAPE
+from inference import MODEL_PATH
+from model import ARCHITECTURES, DEFAULT_ARCH, build
+from utils.utils import logger
+
+
+def weights_path(arch):
+    return MODEL_PATH if arch == DEFAULT_ARCH else f"model/{arch}.best.pkl"
+
+
+def gru_flops(model, x):
+    # FlopCounterMode only counts matmuls and convs, add the GRU gates by hand.
+    flops = 0
+    for module in model.modules():
+        if isinstance(module, torch.nn.GRU):
+            steps = model.frames(x).size(1)
+            directions = 2 if module.bidirectional else 1
+            size = module.input_size + module.hidden_size
+            flops += 2 * 3 * size * module.hidden_size * steps * directions
+    return flops
+
+
+@torch.inference_mode()
+def flops(model):
+    x = torch.zeros(EXAMPLE_SHAPE)
+    with FlopCounterMode(display=False) as counter:
+        model(x)
+    return counter.get_total_flops() + gru_flops(model, x)
+
+
+@torch.inference_mode()
+def latency(model, batch, runs):
+    x = torch.rand((batch,) + EXAMPLE_SHAPE[1:]) * 2 - 1
+    model(x)  # warm up
+    latencies = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        model(x)
+        latencies.append(time.perf_counter() - start)
+    return sorted(latencies)[len(latencies) // 2]
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("archs", nargs="*", default=list(ARCHITECTURES))
+    parser.add_argument("--runs", type=int, default=50)
+    parser.add_argument("--test", default="data/test")
+    args = parser.parse_args()
+
+    loader = get_evaluate_data_loader(args.test) if os.path.isdir(args.test) else None
+    for arch in args.archs:
+        model = build(arch).eval()
+        path = weights_path(arch)
+        accuracy = "untrained"
+        if loader and os.path.exists(path):
+            model.load_state_dict(torch.load(path, map_location="cpu"))
+            accuracy = f"{evaluate(model, loader):.2f}%"
+        logger.info(
+            f"Benchmark: {arch}: "
+            f"{sum(p.numel() for p in model.parameters()) / 1e6:.2f}M params, "
+            f"{flops(model) / 1e9:.3f} GFLOPs, "
+            f"batch 1 {1000 * latency(model, 1, args.runs):.2f}ms, "
+            f"batch 32 {1000 * latency(model, 32, args.runs):.1f}ms, "
+            f"test accuracy {accuracy}"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,82 @@
+# Compare BeautifulSoup with the targeted extraction in utils.pages, per page.
+# Usage: python -m benchmark.pages [--pages saved_login.html saved_home.html]
+import argparse
+import time
+
+from bs4 import BeautifulSoup
+
+from benchmark.mockserver import HOME_PAGE, LOGIN_PAGE, PADDING
+from utils.pages import checked_in, find_execution
+from utils.utils import logger
+
+
+def soup_execution(content):
+    soup = BeautifulSoup(content, "lxml")
+    execution = soup.find("input", attrs={"type": "hidden", "name": "execution"})
+    return execution.get("value") if execution else None
+
+
+def soup_checked_in(content):
+    soup = BeautifulSoup(content, "lxml")
+    return "success" in str(soup.find("div", attrs={"class": "form-group"}))
+
+
+def timeit(function, content, repeat):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        function(content)
+    return (time.perf_counter() - start) / repeat
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--pages", nargs="*", default=[], help="saved html pages")
+    parser.add_argument("--repeat", type=int, default=200)
+    args = parser.parse_args()
+
+    pages = {
+        "login": LOGIN_PAGE.format(execution="e1s1", padding=PADDING).encode(),
+        "home": HOME_PAGE.format(status="success", padding=PADDING).encode(),
+        "home (not checked in)": HOME_PAGE.format(
+            status="未打卡", padding=PADDING
+        ).encode(),
+        "login (escaped execution)": LOGIN_PAGE.format(
+            execution="e1s1&amp;a&#x2F;b", padding=PADDING
+        ).encode(),
+        "login (> in an attribute)": LOGIN_PAGE.replace(
+            '<input type="hidden" name="execution"',
+            '<input type="hidden" data-hint="a > b" name="execution"',
+        )
+        .format(execution="e1s1", padding=PADDING)
+        .encode(),
+        "home (> in an attribute)": HOME_PAGE.replace(
+            '<div class="form-group">{status}',
+            '<div title="a > b" class="form-group">{status}',
+        )
+        .format(status="success", padding=PADDING)
+        .encode(),
+    }
+    for path in args.pages:
+        with open(path, "rb") as file:
+            pages[path] = file.read()
+
+    for name, content in pages.items():
+        for label, soup, fast in (
+            ("execution", soup_execution, find_execution),
+            ("checked_in", soup_checked_in, checked_in),
+        ):
+            expected, got = soup(content), fast(content)
+            if expected != got:
+                logger.error(f"Pages: {name} {label}: soup {expected!r}, pages {got!r}")
+                raise SystemExit(1)
+            soup_time = timeit(soup, content, args.repeat)
+            fast_time = timeit(fast, content, args.repeat)
+            logger.info(
+                f"Pages: {name} ({len(content)} bytes) {label}: "
+                f"soup {1e6 * soup_time:.0f}us, pages {1e6 * fast_time:.0f}us "
+                f"({soup_time / fast_time:.0f}x)"
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,145 @@
+# Time until each daemon is up (checkin.py scheduler started, checkin-bot.py
+# polling) and its idle RSS, from its "Startup: Ready" log line.
+# Usage: python -m benchmark.startup [checkin bot] [--accounts 1000] [--max-seconds 3 --max-rss-mb 150]
+# The bot talks to a local stand-in for the Telegram Bot API (BASE_URL).
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from benchmark.load import accounts
+from utils.utils import logger
+
+SCRIPTS = {"checkin": "checkin.py", "bot": "checkin-bot.py"}
+ROOT = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+BOT = {
+    "id": 1,
+    "is_bot": True,
+    "first_name": "Daka",
+    "username": "daka_bot",
+    "can_join_groups": True,
+    "can_read_all_group_messages": False,
+    "supports_inline_queries": False,
+}
+
+
+class BotApiHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        method = self.path.rsplit("/", 1)[-1]
+        if method == "getUpdates":
+            time.sleep(1)  # a long poll without updates
+        result = BOT if method == "getMe" else [] if method == "getUpdates" else True
+        body = json.dumps({"ok": True, "result": result}).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+def status(pid, key):
+    with open(f"/proc/{pid}/status") as file:
+        for line in file:
+            if line.startswith(key + ":"):
+                return int(line.split()[1])
+
+
+def measure(name, config, idle, timeout=120):
+    with tempfile.TemporaryDirectory() as folder:
+        config = dict(
+            config,
+            STORE_PATH=os.path.join(folder, "accounts.db"),
+            SESSION_DIR=os.path.join(folder, "sessions"),
+        )
+        path = os.path.join(folder, "config.json")
+        with open(path, "w") as file:
+            json.dump(config, file)
+        start = time.perf_counter()
+        process = subprocess.Popen(
+            [sys.executable, os.path.join(ROOT, SCRIPTS[name]), path],
+            stdin=subprocess.DEVNULL,
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.PIPE,
+            text=True,
+        )
+        lines, up = [], threading.Event()
+
+        def read():
+            for line in process.stderr:
+                lines.append(line)
+                if "Startup: Ready" in line:
+                    up.set()
+
+        threading.Thread(target=read, daemon=True).start()
+        try:
+            if not up.wait(timeout):
+                raise RuntimeError(f"{name} did not start:\n{''.join(lines)}")
+            ready = time.perf_counter() - start
+            time.sleep(idle)
+            rss, threads = status(process.pid, "VmRSS"), status(process.pid, "Threads")
+        finally:
+            process.kill()
+            process.wait()
+    return {
+        "name": name,
+        "seconds": ready,
+        "rss_mb": rss / 1024,
+        "threads": threads,
+        "model_loaded": any("Detect: Loaded" in line for line in lines),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("names", nargs="*", default=list(SCRIPTS))
+    parser.add_argument("--accounts", type=int, default=1000)
+    parser.add_argument("--idle", type=float, default=2, help="seconds before RSS")
+    parser.add_argument("--max-seconds", type=float, help="fail above this startup")
+    parser.add_argument("--max-rss-mb", type=float, help="fail above this idle RSS")
+    args = parser.parse_args()
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), BotApiHandler)
+    server.daemon_threads = True
+    server.handle_error = lambda request, address: None  # killed daemons
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    users = accounts(args.accounts)
+    for user in users:
+        user["CHAT"] = 1
+    config = {
+        "TOKEN": "1:benchmark",
+        "ADMIN": 1,
+        "BASE_URL": f"http://127.0.0.1:{server.server_address[1]}/bot",
+        "USERS": users,
+    }
+    failed = False
+    for name in args.names:
+        result = measure(name, config, args.idle)
+        logger.info(
+            f"Benchmark: {name}: ready in {result['seconds']:.2f}s with "
+            f"{args.accounts} accounts, idle RSS {result['rss_mb']:.1f}MB, "
+            f"{result['threads']} threads, model "
+            f"{'loaded' if result['model_loaded'] else 'not loaded'} at startup"
+        )
+        if args.max_seconds and result["seconds"] > args.max_seconds:
+            logger.error(f"Benchmark: {name} started slower than {args.max_seconds}s")
+            failed = True
+        if args.max_rss_mb and result["rss_mb"] > args.max_rss_mb:
+            logger.error(f"Benchmark: {name} idles above {args.max_rss_mb}MB")
+            failed = True
+    if failed:
+        raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    main()
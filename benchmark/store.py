@@ -0,0 +1,78 @@
+# Time the bot's account store against scanning job contexts, as the bot used to.
+# Usage: python -m benchmark.store [--accounts 10000] [--chats 1000]
+import argparse
+import datetime
+import os
+import random
+import tempfile
+import time
+
+from utils.store import AccountStore, daily_time
+from utils.utils import logger
+
+
+def timeit(function, repeat):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        function()
+    return (time.perf_counter() - start) / repeat
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--accounts", type=int, default=10000)
+    parser.add_argument("--chats", type=int, default=1000)
+    parser.add_argument("--repeat", type=int, default=200)
+    args = parser.parse_args()
+
+    accounts = [
+        (
+            f"2017{i:08d}",
+            "password",
+            1,
+            i % args.chats,
+            datetime.time(0, random.randrange(60), random.randrange(60)),
+        )
+        for i in range(args.accounts)
+    ]
+    with tempfile.TemporaryDirectory() as folder:
+        path = os.path.join(folder, "accounts.db")
+        start = time.perf_counter()
+        AccountStore(path).add_many(accounts)
+        logger.info(
+            f"Store: Inserted {args.accounts} accounts in "
+            f"{time.perf_counter() - start:.3f}s"
+        )
+        # What a restart pays before the bot is ready again.
+        start = time.perf_counter()
+        store = AccountStore(path)
+        rows = store.all()
+        times = [daily_time(row) for row in rows]
+        logger.info(
+            f"Store: Reopened and read {len(times)} schedules in "
+            f"{time.perf_counter() - start:.3f}s"
+        )
+        contexts = [{"username": row["username"], "chat": row["chat"]} for row in rows]
+        username, chat = accounts[-1][0], accounts[-1][3]
+        for name, indexed, scan in (
+            (
+                "by username",
+                lambda: store.get(username),
+                lambda: [c for c in contexts if c["username"] == username],
+            ),
+            (
+                "by chat",
+                lambda: store.by_chat(chat),
+                lambda: [c for c in contexts if c["chat"] == chat],
+            ),
+        ):
+            indexed_time = timeit(indexed, args.repeat)
+            scan_time = timeit(scan, args.repeat)
+            logger.info(
+                f"Store: Lookup {name}: sqlite {1e6 * indexed_time:.0f}us, "
+                f"job queue scan {1e6 * scan_time:.0f}us"
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -1,125 +1,75 @@
 #!/usr/bin/env python
+import asyncio
 import datetime
 import json
 import os
 import sys
+import time
 from random import SystemRandom
 
-import numpy as np
-import requests
-import torch
-from bs4 import BeautifulSoup
-from PIL import Image
-from telegram.ext import CommandHandler, Updater
-from telegram.ext.dispatcher import run_async
+from telegram.ext import Application, CommandHandler
 
-from dataset import transform
-from model import ResidualBlock, ResNet
-from utils.utils import LabeltoStr, device, logger
+import checkin
+from checkin import (
+    jobs,
+    loop_lag,
+    make_client,
+    make_predictor,
+    make_transport,
+    stages,
+)
+from utils.metrics import configure, monitor_loop_lag
+from utils.ratelimit import TokenBucket
+from utils.schedule import WARM_UP_MINUTES, before, spread, window
+from utils.sessions import SESSION_DIR, SESSION_TTL, SessionStore
+from utils.store import STORE_PATH, AccountStore, daily_time
+from utils.utils import logger
 
-DK_URL = "https://dk.shmtu.edu.cn/"
-CAPTCHA_URL = "https://cas.shmtu.edu.cn/cas/captcha"
-CHECKIN_URL = DK_URL + "checkin"
+REGIONS = (1, 2, 3, 5)  # 上海, 湖北, 其他中国地区, 国外
 
+# username -> daily Job, so commands never scan the job queue
+scheduled = {}
+rebalance_pending = False
 
-model = ResNet(ResidualBlock)
-model.eval()
-model.load_state_dict(torch.load("model/best.pkl", map_location=device))
 
-
-def detect(Img):
-    logger.info(f"Detect: Detecting...")
-    i = transform(Img).unsqueeze(0)
-    predict_label1, predict_label2 = model(i)
-    predict_label = LabeltoStr(
-        [
-            np.argmax(predict_label1.data.numpy()[0]),
-            np.argmax(predict_label2.data.numpy()[0]),
-        ]
-    )
-    logger.info(f"Detect: Result {predict_label}")
-    return predict_label
-
-
-def login(s, username, password):
-    home = s.get(DK_URL)
-    soup = BeautifulSoup(home.content, "lxml")
-    captcha = s.get(CAPTCHA_URL, stream=True)
-    valid_code = detect(Image.open(captcha.raw))
-    execution = soup.find("input", attrs={"type": "hidden", "name": "execution"})
-    data = {
-        "username": username,
-        "password": password,
-        "validateCode": valid_code,
-        "execution": execution.get("value"),
-        "_eventId": "submit",
-        "geolocation": "",
-    }
-    post = s.post(home.url, data=data)
-    logger.info(f"Login: {username} Login...")
-    return True if post.url == DK_URL else False
-
-
-def checkin(s, username, region):
-    data = {
-        "xgh": username,
-        "lon": "",
-        "lat": "",
-        "region": region,
-        "rylx": 4,
-        "status": 0,
-    }
-    s.post(CHECKIN_URL, data=data)
-    logger.info(f"Checkin: {username} Checkin...")
-    home = s.get(DK_URL)
-    soup = BeautifulSoup(home.content, "lxml")
-    return (
-        True
-        if "success" in str(soup.find("div", attrs={"class": "form-group"}))
-        else False
-    )
-
-
-@run_async
-def checkin_queue(context):
+async def checkin_queue(context):
     job = context.job
     username, password, region, chat = (
-        job.context.get("username"),
-        job.context.get("password"),
-        job.context.get("region"),
-        job.context.get("chat"),
-    )
-    s = requests.Session()
-    s.headers.update(
-        {
-            "User-Agent": "Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/80.0.3987.87 Safari/537.36"
-        }
+        job.data.get("username"),
+        job.data.get("password"),
+        job.data.get("region"),
+        job.data.get("chat"),
     )
-    retry_count = 5
-    for i in range(retry_count):
-        try:
-            if login(s, username, password):
-                logger.info(f"Login: {username} Success!")
-                break
-        except:
-            continue
-        logger.warning(f"Login: {username} Fail {i}")
-    for i in range(retry_count):
-        try:
-            if checkin(s, username, region):
-                logger.info(f"Checkin: {username} Success!")
-                context.bot.send_message(
-                    chat, f"任务: {username} 执行成功！", disable_notification=True
-                )
-                return
-        except:
-            continue
-        logger.warning(f"Checkin: {username} Fail {i}")
-    context.bot.send_message(chat, f"任务: {username} 执行失败！预计下个小时将继续执行。")
+    # The checkin.py flow: a client per account for its cookies, all on the
+    # shared connection pool, and inference on the predictor's own threads.
+    with stages.time("queue", username=username):
+        await semaphore.acquire()
+    try:
+        with stages.time("job", username=username):
+            result = await checkin.user(
+                username, password, region, client=make_client(transport, bucket)
+            )
+    except Exception:
+        jobs.inc("error")
+        logger.exception(f"Job: {username} failed")
+        result = False
+    finally:
+        semaphore.release()
+    logger.info(f"Job: {checkin.policy.summary()}")
+    store.record(username, result)
+    with stages.time("notify", username=username):
+        if result:
+            await context.bot.send_message(
+                chat, f"任务: {username} 执行成功！", disable_notification=True
+            )
+            return
+        await context.bot.send_message(
+            chat, f"任务: {username} 执行失败！预计下个小时将继续执行。"
+        )
     context.job_queue.run_once(
         checkin_queue,
         SystemRandom().randint(1800, 3600),
-        context={
+        data={
             "username": username,
             "password": password,
             "region": region,
@@ -129,11 +79,66 @@ def checkin_queue(context):
     logger.warning(f"Job: {username} fail -> run in next hour")
 
 
-@run_async
-def start(update, context):
+def schedule(job_queue, account):
+    job = scheduled.pop(account["username"], None)
+    if job:
+        job.schedule_removal()
+    scheduled[account["username"]] = job_queue.run_daily(
+        checkin_queue,
+        daily_time(account),
+        data={
+            "username": account["username"],
+            "password": account["password"],
+            "region": account["region"],
+            "chat": account["chat"],
+        },
+        name=account["username"],
+    )
+
+
+def rebalance_times():
+    """Spreads all accounts over the window again, returns the ones that moved."""
+    accounts = store.all()
+    times = spread(
+        [account["username"] for account in accounts],
+        [account["username"] for account in accounts if account["last_result"] == 0],
+        **times_window,
+    )
+    moved = [
+        dict(account, time=times[account["username"]].isoformat())
+        for account in accounts
+        if times[account["username"]].isoformat() != account["time"]
+    ]
+    store.set_times(
+        {account["username"]: times[account["username"]] for account in moved}
+    )
+    logger.info(f"Schedule: Rebalanced {len(accounts)} accounts, moved {len(moved)}")
+    return moved
+
+
+async def rebalance(context):
+    global rebalance_pending
+    rebalance_pending = False
+    for account in rebalance_times():
+        schedule(context.job_queue, account)
+
+
+def request_rebalance(job_queue):
+    # Batches the /add and /del of the next minute into one rebalance.
+    global rebalance_pending
+    if not rebalance_pending:
+        rebalance_pending = True
+        job_queue.run_once(rebalance, 60)
+
+
+def chat_jobs(chat):
+    return [account["username"] for account in store.by_chat(chat)]
+
+
+async def start(update, context):
     message = update.message
-    jobs = [t.name for t in context.job_queue.jobs()]
-    message.reply_text(
+    jobs = chat_jobs(message.chat.id)
+    await message.reply_text(
         "用法:\n"
         "添加数字平台账户:\n"
         "/add <学号> <密码> [地区]\n"
@@ -148,18 +153,23 @@ def start(update, context):
         "/run [学号]\n"
         f"现在的任务列表: {jobs}"
     )
-    logger.info(
-        f"Start command: Current Jobs: {[t.context for t in context.job_queue.jobs()]}"
-    )
+    logger.info(f"Start command: {len(scheduled)} jobs, chat jobs: {jobs}")
 
 
-@run_async
-def add(update, context):
+async def add(update, context):
     message = update.message
     chat = message.chat
     data = message.text.split(" ")
-    if len(data) < 3:
-        message.reply_text(
+    try:
+        if len(data) < 3:
+            raise ValueError(data)
+        username, password = data[1], data[2]
+        region = 1 if len(data) <= 3 else int(data[3])
+        chat_id = chat.id if len(data) <= 4 else int(data[4])
+        if region not in REGIONS:
+            raise ValueError(region)
+    except ValueError:
+        await message.reply_text(
             "用法:\n"
             "添加数字平台账户:\n"
             "/add <学号> <密码> \\[地区]\n"
@@ -170,100 +180,69 @@ def add(update, context):
             "5 - 国外"
         )
         return
-    username, password = data[1], data[2]
-    region = 1 if len(data) <= 3 else data[3]
-    chat_id = chat.id if len(data) <= 4 else data[4]
-    for job in context.job_queue.get_jobs_by_name(username):
-        job.schedule_removal()
-    jobs = [t.name for t in context.job_queue.jobs()]
-    context.job_queue.run_daily(
-        checkin_queue,
-        datetime.time(
-            0,
-            min(3 + len(jobs), 59),
-            SystemRandom().randrange(60),
-            SystemRandom().randrange(1000000),
-            datetime.timezone(datetime.timedelta(hours=8)),
-        ),
-        context={
-            "username": username,
-            "password": password,
-            "region": region,
-            "chat": chat_id,
-        },
-        name=username,
-    )
-    jobs.append(username)
+    # Starts at the beginning of the window until the next rebalance.
+    store.add(username, password, region, chat_id, times_window["start"])
+    account = store.get(username)
+    schedule(context.job_queue, account)
+    request_rebalance(context.job_queue)
     context.job_queue.run_once(
         checkin_queue,
         1,
-        context={
+        data={
             "username": username,
             "password": password,
-            "region": region,
+            "region": account["region"],
             "chat": chat_id,
         },
     )
-    message.reply_text(
+    jobs = chat_jobs(chat_id)
+    await message.reply_text(
         f"添加成功!\n学号: {username}\n密码: {password}\n地区: {region}\n现在的任务列表: {jobs}"
     )
     logger.info(f"Added Jobs: {username}, Current Jobs: {jobs}")
 
 
-@run_async
-def delete(update, context):
+async def delete(update, context):
     message = update.message
     chat = message.chat
     data = message.text.split(" ")
     if len(data) < 2:
-        message.reply_text("用法:\n移除数字平台账户:\n/del <学号>")
+        await message.reply_text("用法:\n移除数字平台账户:\n/del <学号>")
         return
     username = data[1]
-    deleted_flag = False
-    jobs = [t.name for t in context.job_queue.jobs()]
-    for job in context.job_queue.get_jobs_by_name(username):
-        if job.context.get("chat") in [chat.id, ADMIN]:
-            deleted_flag = True
+    account = store.get(username)
+    if account and account["chat"] in [chat.id, ADMIN]:
+        store.delete(username)
+        job = scheduled.pop(username, None)
+        if job:
             job.schedule_removal()
-            logger.info(f"Deleted Jobs: {username}, Current Jobs: {jobs}")
-    if deleted_flag:
-        message.reply_text(f"删除成功!\n学号: {username}\n现在的任务列表: {jobs}")
+        request_rebalance(context.job_queue)
+        jobs = chat_jobs(chat.id)
+        logger.info(f"Deleted Jobs: {username}, Current Jobs: {jobs}")
+        await message.reply_text(f"删除成功!\n学号: {username}\n现在的任务列表: {jobs}")
     else:
-        message.reply_text("您没有删除此账户的权限.")
+        await message.reply_text("您没有删除此账户的权限.")
 
 
-@run_async
-def run(update, context):
+async def run(update, context):
     message = update.message
     chat = message.chat
     data = message.text.split(" ")
     if len(data) > 1:
         if len(data[1]) == 12:
-            jobs = [
-                t.context
-                for t in context.job_queue.jobs()
-                if t.context.get("username") == data[1]
-            ]
+            jobs = [account for account in [store.get(data[1])] if account]
         elif data[1] == "all":
-            jobs = [t.context for t in context.job_queue.jobs()]
+            jobs = store.all()
         else:
-            jobs = [
-                t.context
-                for t in context.job_queue.jobs()
-                if t.context.get("chat") == data[1]
-            ]
+            jobs = store.by_chat(data[1])
     else:
-        jobs = [
-            t.context
-            for t in context.job_queue.jobs()
-            if t.context.get("chat") == chat.id
-        ]
+        jobs = store.by_chat(chat.id)
     if jobs:
         for job in jobs:
             context.job_queue.run_once(
                 checkin_queue,
                 1,
-                context={
+                data={
                     "username": job.get("username"),
                     "password": job.get("password"),
                     "region": job.get("region"),
@@ -271,12 +250,13 @@ def run(update, context):
                 },
             )
     else:
-        message.reply_text("未找到账户，请先使用 /add 命令添加！\n用法:\n立即运行:\n/run [学号]")
+        await message.reply_text(
+            "未找到账户，请先使用 /add 命令添加！\n用法:\n立即运行:\n/run [学号]"
+        )
 
 
-@run_async
-def error(update, context):
-    logger.warning(f"Update {context} caused error {error}")
+async def error(update, context):
+    logger.warning(f"Update {update} caused error {context.error}")
 
 
 def load_json(filename="config.json"):
@@ -295,42 +275,97 @@ def load_json(filename="config.json"):
     return config
 
 
+async def warm_up(context):
+    await asyncio.get_running_loop().run_in_executor(None, checkin.predictor.warm_up)
+
+
+async def ready(context):
+    # The job queue starts after polling, so this is when the bot is up.
+    logger.info(f"Startup: Ready in {time.perf_counter() - started:.2f}s")
+
+
+async def post_init(application):
+    global transport, bucket, semaphore
+    transport = make_transport(CONCURRENCY)
+    bucket = TokenBucket(RATE)
+    semaphore = asyncio.Semaphore(CONCURRENCY)
+    asyncio.get_running_loop().create_task(monitor_loop_lag(loop_lag))
+    logger.info(f"Bot @{application.bot.username} started.")
+    await application.bot.set_my_commands(
+        [
+            ("start", "使用说明"),
+            ("add", "添加数字平台账户"),
+            ("del", "移除数字平台账户"),
+            ("run", "立即运行"),
+        ]
+    )
+    store.add_many(
+        (
+            conf.get("USERNAME"),
+            conf.get("PASSWORD"),
+            conf.get("REGION", 1),
+            conf.get("CHAT"),
+            times_window["start"],
+        )
+        for conf in config.get("USERS", [])
+    )
+    rehydrate = time.perf_counter()
+    rebalance_times()
+    for account in store.all():
+        schedule(application.job_queue, account)
+    tz = datetime.timezone(datetime.timedelta(hours=8))
+    # Once a day before the window, so yesterday's failures go first.
+    application.job_queue.run_daily(
+        rebalance, before(times_window["start"]).replace(tzinfo=tz)
+    )
+    minutes = config.get("WARM_UP_MINUTES", WARM_UP_MINUTES)
+    if minutes:
+        application.job_queue.run_daily(
+            warm_up, before(times_window["start"], minutes).replace(tzinfo=tz)
+        )
+    application.job_queue.run_once(ready, 0)
+    logger.info(
+        f"Bot: Rehydrated {len(scheduled)} jobs in "
+        f"{time.perf_counter() - rehydrate:.2f}s"
+    )
+
+
+async def post_shutdown(application):
+    await transport.aclose()
+
+
 if __name__ == "__main__":
+    started = time.perf_counter()
     if len(sys.argv) >= 2 and os.path.exists(sys.argv[1]):
         config = load_json(sys.argv[1])
     else:
         config = load_json()
     TOKEN, ADMIN = config.get("TOKEN"), config.get("ADMIN")
-    logger.info(f"Bot: Starting & Sending to {ADMIN}")
-    updater = Updater(
-        TOKEN, use_context=True, request_kwargs=config.get("REQUEST_KWARGS")
+    CONCURRENCY, RATE = config.get("CONCURRENCY", 8), config.get("RATE", 10)
+    checkin.predictor = make_predictor(config)
+    checkin.sessions = SessionStore(
+        config.get("SESSION_DIR", SESSION_DIR), config.get("SESSION_TTL", SESSION_TTL)
     )
-    updater.dispatcher.add_handler(CommandHandler("start", start))
-    updater.dispatcher.add_handler(CommandHandler("add", add))
-    updater.dispatcher.add_handler(CommandHandler("del", delete))
-    updater.dispatcher.add_handler(CommandHandler("run", run))
-    updater.dispatcher.add_error_handler(error)
-    updater.start_polling()
-    logger.info(f"Bot @{updater.bot.get_me().username} started.")
-    updater.bot.set_my_commands(
-        [["start", "使用说明"], ["add", "添加数字平台账户"], ["del", "移除数字平台账户"], ["run", "立即运行"]]
+    store = AccountStore(config.get("STORE_PATH", STORE_PATH))
+    configure(config)
+    times_window = window(config)
+    logger.info(f"Bot: Starting & Sending to {ADMIN}")
+    builder = (
+        Application.builder()
+        .token(TOKEN)
+        .post_init(post_init)
+        .post_shutdown(post_shutdown)
     )
-    for i, conf in enumerate(config.get("USERS")):
-        updater.job_queue.run_daily(
-            checkin_queue,
-            datetime.time(
-                0,
-                2 + i,
-                SystemRandom().randrange(60),
-                SystemRandom().randrange(1000000),
-                datetime.timezone(datetime.timedelta(hours=8)),
-            ),
-            context={
-                "username": conf.get("USERNAME"),
-                "password": conf.get("PASSWORD"),
-                "chat": conf.get("CHAT"),
-                "region": conf.get("REGION", 1),
-            },
-            name=conf.get("USERNAME"),
-        )
-    updater.idle()
+    if config.get("BASE_URL"):
+        # A self-hosted Bot API server, or benchmark.startup's stand-in
+        builder = builder.base_url(config["BASE_URL"])
+    proxy = (config.get("REQUEST_KWARGS") or {}).get("proxy_url")
+    if proxy:
+        builder = builder.proxy(proxy).get_updates_proxy(proxy)
+    application = builder.build()
+    application.add_handler(CommandHandler("start", start))
+    application.add_handler(CommandHandler("add", add))
+    application.add_handler(CommandHandler("del", delete))
+    application.add_handler(CommandHandler("run", run))
+    application.add_error_handler(error)
+    application.run_polling()
@@ -1,60 +1,116 @@
+import asyncio
+import datetime
 import json
 import os
 import sys
+import time
+from functools import partial
 
 import httpx
-import numpy as np
-import torch
 import uvloop
 from apscheduler.schedulers.asyncio import AsyncIOScheduler
-from bs4 import BeautifulSoup
-from PIL import Image
 
-from dataset import transform
-from model import ResidualBlock, ResNet
-from utils.utils import LabeltoStr, device, logger
+from inference import (
+    CACHE_SIZE,
+    CACHE_TTL,
+    MAX_REFETCH,
+    MIN_CONFIDENCE,
+    BatchPredictor,
+    CaptchaCache,
+    load_models,
+)
+from utils.metrics import (
+    Counter,
+    Histogram,
+    Stages,
+    configure,
+    monitor_loop_lag,
+    percentile,
+)
+from utils.pages import checked_in, find_execution
+from utils.ratelimit import TokenBucket
+from utils.retry import CheckinFailed, GiveUp, RetryPolicy, WrongCaptcha, check_status
+from utils.schedule import (
+    WARM_UP_MINUTES,
+    before,
+    by_minute,
+    deadline,
+    spread,
+    window,
+)
+from utils.sessions import SESSION_DIR, SESSION_TTL, SessionStore
+from utils.utils import logger
 
-DK_URL = "https://dk.shmtu.edu.cn/"
-CAPTCHA_URL = "https://cas.shmtu.edu.cn/cas/captcha"
+# Overridable to point the daemons at a local stand-in server
+DK_URL = os.environ.get("DK_URL", "https://dk.shmtu.edu.cn/")
+CAS_URL = os.environ.get("CAS_URL", "https://cas.shmtu.edu.cn/cas/")
+CAPTCHA_URL = CAS_URL + "captcha"
 CHECKIN_URL = DK_URL + "checkin"
 ARRSH_URL = DK_URL + "arrsh"
+HEADERS = {
+    "User-Agent": "Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/80.0.3987.87 Safari/537.36"
+}
 
-model = ResNet(ResidualBlock)
-model.eval()
-model.load_state_dict(torch.load("model/best.pkl", map_location=device))
+loop_lag = Histogram("event_loop_lag_seconds", [0.001, 0.01, 0.05, 0.1, 0.5, 1, 5])
+round_trips = Histogram("login_round_trips", [3, 4, 5, 6, 8, 10, 15, 20, 30])
+stages = Stages(
+    "checkin_stage_seconds",
+    [0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30],
+    "Time spent in each stage of a check-in job",
+)
+jobs = Counter("checkin_jobs_total", "result", "Check-in jobs by result")
+predictor = None
+sessions = None
+scheduler = None
+failed = set()  # usernames whose last check-in failed
+deferred = set()  # usernames refused by the open circuit breaker
+policy = RetryPolicy(network_errors=(httpx.TransportError, OSError))
 
 
-async def user(username, password, region, retry_count=5):
+async def user(username, password, region, client=None):
+    trips = 0
+
+    def count(response):
+        nonlocal trips
+        trips += 1 + len(response.history)
+        return check_status(response)
+
+    async def authenticated(client):
+        with stages.time("session_probe", username=username):
+            home = count(await client.get(DK_URL))
+        return home if home.url == DK_URL else None
+
     async def login(client, username, password):
-        def detect(Img):
-            logger.info(f"Detect: Detecting...")
-            i = transform(Img).unsqueeze(0)
-            predict_label1, predict_label2 = model(i)
-            predict_label = LabeltoStr(
-                [
-                    np.argmax(predict_label1.data.numpy()[0]),
-                    np.argmax(predict_label2.data.numpy()[0]),
-                ]
-            )
-            logger.info(f"Detect: Result {predict_label}")
-            return predict_label
-
-        home = await client.get(DK_URL)
-        soup = BeautifulSoup(home.content, "lxml")
-        captcha = await client.get(CAPTCHA_URL)
-        valid_code = detect(Image.open(captcha))
-        execution = soup.find("input", attrs={"type": "hidden", "name": "execution"})
+        with stages.time("login_page", username=username):
+            home = count(await client.get(DK_URL))
+        if home.url == DK_URL:
+            # Already logged in, e.g. a retry after a POST that went through.
+            return home
+        # A new captcha is one cheap GET, a wrong guess costs the whole form
+        # post and a fresh login page.
+        for i in range(predictor.max_refetch + 1):
+            with stages.time("captcha_fetch", username=username):
+                captcha = count(await client.get(CAPTCHA_URL))
+            with stages.time("inference", username=username):
+                prediction = await predictor.detect_async(captcha.content)
+            if prediction.confidence >= predictor.min_confidence:
+                break
+            logger.info(f"Login: {username} Refetch captcha {i}")
         data = {
             "username": username,
             "password": password,
-            "validateCode": valid_code,
-            "execution": execution.get("value"),
+            "validateCode": prediction.label,
+            "execution": find_execution(home.content),
             "_eventId": "submit",
             "geolocation": "",
         }
-        post = await client.post(home.url, data=data)
+        with stages.time("login_post", username=username):
+            post = count(await client.post(home.url, data=data))
         logger.info(f"Login: {username} Login...")
-        return True if post.url == DK_URL else False
+        if post.url != DK_URL:
+            predictor.invalidate(captcha.content)
+            raise WrongCaptcha(username)
+        return post
 
     async def checkin(client, username, region):
         data = {
@@ -66,34 +122,221 @@ async def user(username, password, region, retry_count=5):
             "status": 0,
             "sflx": 1,
         }
-        await client.post(CHECKIN_URL, data=data)
+        with stages.time("checkin_post", username=username):
+            count(await client.post(CHECKIN_URL, data=data))
         logger.info(f"Checkin: {username} Checkin...")
-        home = await client.get(DK_URL)
-        soup = BeautifulSoup(home.content, "lxml")
-        return (
-            True
-            if "success" in str(soup.find("div", attrs={"class": "form-group"}))
-            else False
-        )
+        with stages.time("checkin_verify", username=username):
+            home = count(await client.get(DK_URL))
+        if not checked_in(home.content):
+            raise CheckinFailed(username)
+
+    if client is None:
+        async with httpx.AsyncClient(
+            headers=HEADERS, verify=False, follow_redirects=True
+        ) as client:
+            return await user(username, password, region, client)
+    start = time.perf_counter()
+    try:
+        # Yesterday's CAS session may still be good, then no captcha is needed.
+        restored = sessions and sessions.load(username, client.cookies.jar)
+        home = restored and await policy.run_async(authenticated, client)
+        if home:
+            logger.info(f"Login: {username} Session still valid")
+        else:
+            if restored:
+                sessions.delete(username)
+                client.cookies.clear()
+            home = await policy.run_async(login, client, username, password)
+            logger.info(
+                f"Login: Successful in {time.perf_counter() - start:.2f}s "
+                f"and {trips} requests!"
+            )
+            round_trips.observe(trips)
+            if sessions:
+                sessions.save(username, client.cookies.jar)
+        # Both ways end on the dk home page, which shows today's status.
+        if checked_in(home.content):
+            policy.count("already_checked_in")
+            jobs.inc("already_checked_in")
+            logger.info(f"Checkin: {username} Already checked in")
+            return True
+        await policy.run_async(checkin, client, username, region)
+    except GiveUp as e:
+        jobs.inc(e.kind)
+        if e.kind == "circuit_open":
+            deferred.add(username)
+        logger.warning(f"Job: {username} gave up after {e}")
+        return False
+    jobs.inc("success")
+    logger.info("Checkin: Successful!")
+    if sessions:
+        sessions.save(username, client.cookies.jar)
+    return True
+
+
+def make_predictor(config):
+    # Nothing is loaded until the first captcha or the warm-up before the
+    # window, and with RELEASE_AFTER the models go again after the burst.
+    cache_size = config.get("CACHE_SIZE", CACHE_SIZE)
+    return BatchPredictor(
+        loader=partial(
+            load_models,
+            config.get("MODELS", [None]),
+            config.get("MODEL_PRECISION", "fp32"),
+        ),
+        release_after=config.get("RELEASE_AFTER") or None,
+        workers=config.get("INFERENCE_WORKERS", 1),
+        shifts=config.get("TTA_SHIFTS", []),
+        min_confidence=config.get("MIN_CONFIDENCE", MIN_CONFIDENCE),
+        max_refetch=config.get("MAX_REFETCH", MAX_REFETCH),
+        cache=(
+            CaptchaCache(cache_size, config.get("CACHE_TTL", CACHE_TTL))
+            if cache_size
+            else None
+        ),
+    )
+
+
+def make_transport(concurrency=8):
+    return httpx.AsyncHTTPTransport(
+        verify=False, limits=httpx.Limits(max_connections=2 * concurrency)
+    )
+
+
+def make_client(transport, bucket, timeout=30):
+    # One per account for its own cookie jar. Not closed on its own: that
+    # would close the shared transport.
+    return httpx.AsyncClient(
+        transport=transport,
+        headers=HEADERS,
+        timeout=timeout,
+        follow_redirects=True,
+        event_hooks={"request": [bucket.hook]},
+    )
 
-    headers = {
-        "User-Agent": "Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/80.0.3987.87 Safari/537.36"
-    }
-    async with httpx.AsyncClient(headers=headers, timeout=None, verify=False) as client:
-        for i in range(retry_count):
-            result = await login(client, username, password)
-            if result:
-                logger.info("Login: Successful!")
-                break
-            else:
-                logger.warning(f"Login: {i} Try")
-        for i in range(retry_count):
-            result = await checkin(client, username, region)
-            if result:
-                logger.info("Checkin: Successful!")
-                break
-            else:
-                logger.warning(f"Checkin: {i} Try")
+
+async def run_users(users, concurrency=8, rate=10, timeout=30):
+    """Checks in every account concurrently.
+
+    At most `concurrency` accounts are in flight and all of them together
+    send at most `rate` requests per second. Each account has its own client
+    and so its own cookie jar, but they share one connection pool, so TLS
+    connections to dk/cas are reused across accounts.
+    """
+    bucket = TokenBucket(rate)
+    semaphore = asyncio.Semaphore(concurrency)
+    transport = make_transport(concurrency)
+    latencies = []
+
+    async def run(config):
+        username = config.get("USERNAME")
+        with stages.time("queue", username=username):
+            await semaphore.acquire()
+        client = make_client(transport, bucket, timeout)
+        start = time.perf_counter()
+        try:
+            with stages.time("job", username=username):
+                return await user(
+                    username,
+                    config.get("PASSWORD"),
+                    config.get("REGION", 1),
+                    client=client,
+                )
+        except Exception:
+            jobs.inc("error")
+            logger.exception(f"Job: {username} failed")
+            return False
+        finally:
+            latencies.append(time.perf_counter() - start)
+            semaphore.release()
+
+    start = time.perf_counter()
+    try:
+        results = await asyncio.gather(*map(run, users))
+    finally:
+        await transport.aclose()
+    logger.info(
+        f"Job: {sum(results)}/{len(results)} accounts checked in "
+        f"in {time.perf_counter() - start:.2f}s, per account "
+        f"p50 {percentile(latencies, 50):.2f}s, p99 {percentile(latencies, 99):.2f}s"
+    )
+    predictor.report()
+    logger.info(f"Login: {round_trips.summary()}")
+    logger.info(f"Job: {policy.summary()}")
+    logger.info(f"Job: {jobs.summary()}")
+    logger.info(f"Stage: {stages.summary()}")
+    logger.info(f"Loop: {loop_lag.summary()}")
+    return results
+
+
+async def run_batch(users, window=None, **kwargs):
+    results = await run_users(users, **kwargs)
+    retry = []
+    for config, result in zip(users, results):
+        username = config.get("USERNAME")
+        if result:
+            failed.discard(username)
+        else:
+            failed.add(username)
+        if username in deferred:
+            deferred.discard(username)
+            retry.append(config)
+    if retry:
+        defer(retry, window, **kwargs)
+    return results
+
+
+def defer(users, window, **kwargs):
+    """Runs `users` again once the circuit breaker lets calls through.
+
+    They gave up without sending a request, so an upstream outage of a
+    minute would otherwise make them miss the whole day.
+    """
+    at = datetime.datetime.now() + datetime.timedelta(
+        seconds=policy.breaker.remaining() + 1
+    )
+    if scheduler is None or window is None or at > deadline(window):
+        logger.warning(f"Job: {len(users)} accounts refused by the open circuit")
+        return
+    scheduler.add_job(
+        run_batch,
+        "date",
+        run_date=at,
+        args=[users],
+        kwargs={"window": window, **kwargs},
+        name="checkin",
+    )
+    logger.warning(
+        f"Job: {len(users)} accounts refused by the open circuit, "
+        f"retrying at {at:%H:%M:%S}"
+    )
+
+
+def schedule_users(scheduler, users, window, **kwargs):
+    """Spreads `users` over the check-in window, one cron job per minute.
+
+    Run again before every window, so last night's failures go first.
+    """
+    configs = {config.get("USERNAME"): config for config in users}
+    for job in scheduler.get_jobs():
+        if job.id.startswith("checkin-"):
+            job.remove()
+    groups = by_minute(spread(configs, failed, **window))
+    for (hour, minute), usernames in groups.items():
+        scheduler.add_job(
+            run_batch,
+            "cron",
+            args=[[configs[username] for username in usernames]],
+            kwargs={"window": window, **kwargs},
+            id=f"checkin-{hour:02d}{minute:02d}",
+            name="checkin",
+            hour=hour,
+            minute=minute,
+        )
+    logger.info(
+        f"Schedule: {len(configs)} accounts in {len(groups)} per-minute batches "
+        f"from {window['start']}, {len(failed)} failed ones first"
+    )
 
 
 def load_json(filename="config.json"):
@@ -113,6 +356,7 @@ def load_json(filename="config.json"):
 
 
 if __name__ == "__main__":
+    started = time.perf_counter()
     if len(sys.argv) >= 2 and os.path.exists(sys.argv[1]):
         configs = load_json(sys.argv[1])
     else:
@@ -125,22 +369,37 @@ if __name__ == "__main__":
                 }
             ]
         }
+    predictor = make_predictor(configs)
+    sessions = SessionStore(
+        configs.get("SESSION_DIR", SESSION_DIR), configs.get("SESSION_TTL", SESSION_TTL)
+    )
+    configure(configs)
     loop = uvloop.new_event_loop()
+    loop.create_task(monitor_loop_lag(loop_lag))
     scheduler = AsyncIOScheduler(event_loop=loop)
     scheduler.start()
-    for i, config in enumerate(configs.get("USERS", [])):
-        job = scheduler.add_job(
-            user,
-            "cron",
-            args=[
-                config.get("USERNAME"),
-                config.get("PASSWORD"),
-                config.get("REGION", 1),
-            ],
-            name=config.get("USERNAME"),
-            hour=0,
-            minute=2 + i,
-            jitter=30,
+    users, times = configs.get("USERS", []), window(configs)
+    kwargs = {
+        "concurrency": configs.get("CONCURRENCY", 8),
+        "rate": configs.get("RATE", 10),
+    }
+    schedule_users(scheduler, users, times, **kwargs)
+    start = before(times["start"])
+    scheduler.add_job(
+        schedule_users,
+        "cron",
+        args=[scheduler, users, times],
+        kwargs=kwargs,
+        name="rebalance",
+        hour=start.hour,
+        minute=start.minute,
+    )
+    warm_up = configs.get("WARM_UP_MINUTES", WARM_UP_MINUTES)
+    if warm_up:
+        at = before(times["start"], warm_up)
+        # A plain function, so APScheduler runs it on a thread, not the loop.
+        scheduler.add_job(
+            predictor.warm_up, "cron", name="warm_up", hour=at.hour, minute=at.minute
         )
-        logger.info(job.next_run_time)
+    logger.info(f"Startup: Ready in {time.perf_counter() - started:.2f}s")
     loop.run_forever()
@@ -1,12 +1,21 @@
 import os
 
 import numpy as np
+import torch
 import torchvision.transforms as transforms
 from PIL import Image
 from torch import Tensor
-from torch.utils.data import DataLoader, Dataset
+from torch.utils.data import (
+    BatchSampler,
+    DataLoader,
+    Dataset,
+    DistributedSampler,
+    RandomSampler,
+    SequentialSampler,
+)
 
-from utils.utils import StrtoLabel
+from pack import is_packed, packed_paths
+from utils.utils import StrtoLabel, device
 
 transform = transforms.Compose(
     [
@@ -17,11 +26,11 @@ transform = transforms.Compose(
 
 
 class selfdataset(Dataset):
-    def __init__(self, folder):
+    def __init__(self, folder, raw=False):
         self.train_image_file_paths = [
             os.path.join(folder, image_file) for image_file in os.listdir(folder)
         ]
-        self.transform = transform
+        self.transform = to_uint8 if raw else transform
 
     def __len__(self):
         return len(self.train_image_file_paths)
@@ -36,16 +45,166 @@ class selfdataset(Dataset):
         return image, labelTensor
 
 
-def get_train_data_loader():
-    dataset = selfdataset("data/train")
-    return DataLoader(dataset, batch_size=64, shuffle=True, num_workers=8)
+def to_uint8(image):
+    return torch.from_numpy(np.asarray(image.convert("RGB"))).permute(2, 0, 1)
+
+
+def normalize(images):
+    # transform on a whole uint8 batch: ToTensor (/255) then Normalize(0.5, 0.5)
+    return images.float().div_(127.5).sub_(1)
+
+
+class packeddataset(Dataset):
+    """Images decoded once by pack.py, memory-mapped as uint8 [N, 3, H, W].
+
+    Indexing with a list of indices (as handed out by a BatchSampler) returns
+    a whole batch, so the DataLoader has nothing left to collate. With `raw`
+    the batch stays uint8 and normalization is left to DevicePrefetcher.
+    """
+
+    def __init__(self, folder, raw=False):
+        image_path, label_path = packed_paths(folder)
+        # Copy-on-write keeps the mapping writable for torch.from_numpy
+        # without ever touching the file.
+        self.images = np.load(image_path, mmap_mode="c")
+        self.labels = np.load(label_path)
+        self.raw = raw
+
+    def __len__(self):
+        return len(self.labels)
+
+    def __getitem__(self, idx):
+        if not isinstance(idx, int):
+            # Sorted indices turn the gather into mostly sequential reads.
+            idx = np.sort(idx)
+        images = torch.from_numpy(self.images[idx])
+        if not self.raw:
+            images = normalize(images)
+        return images, torch.from_numpy(self.labels[idx])
+
+
+class indexeddataset(Dataset):
+    """Also returns the dataset indices of the samples, e.g. to look up cached
+    teacher logits in distill.py."""
+
+    def __init__(self, dataset):
+        self.dataset = dataset
+
+    def __len__(self):
+        return len(self.dataset)
+
+    def __getitem__(self, idx):
+        images, labels = self.dataset[idx]
+        if not isinstance(idx, int):
+            idx = np.sort(idx)  # packeddataset returns the batch sorted
+        return images, labels, torch.as_tensor(idx)
+
+
+class DevicePrefetcher:
+    """Moves raw uint8 batches to `device` and normalizes them there.
+
+    On CUDA the next batch is copied from pinned memory on a side stream
+    while the current one is being used, so the copy overlaps with compute.
+    """
+
+    def __init__(self, loader, device=device):
+        self.loader = loader
+        self.device = device
+        self.stream = torch.cuda.Stream(device) if device.type == "cuda" else None
+
+    def __len__(self):
+        return len(self.loader)
+
+    def load(self, batch):
+        images, labels = batch
+        images = images.to(self.device, non_blocking=True)
+        labels = labels.to(self.device, non_blocking=True)
+        return normalize(images), labels.long()
+
+    def preload(self, batches):
+        batch = next(batches, None)
+        if batch is None:
+            return None
+        with torch.cuda.stream(self.stream):
+            return self.load(batch)
+
+    def __iter__(self):
+        if self.stream is None:
+            yield from map(self.load, self.loader)
+            return
+        batches = iter(self.loader)
+        batch = self.preload(batches)
+        while batch is not None:
+            torch.cuda.current_stream(self.device).wait_stream(self.stream)
+            for tensor in batch:
+                tensor.record_stream(torch.cuda.current_stream(self.device))
+            next_batch = self.preload(batches)
+            yield batch
+            batch = next_batch
+
+
+def get_data_loader(
+    folder,
+    batch_size,
+    shuffle,
+    num_workers=8,
+    raw=False,
+    distributed=False,
+    indexed=False,
+):
+    pin_memory = raw and device.type == "cuda"
+    packed = is_packed(folder)
+    dataset = packeddataset(folder, raw) if packed else selfdataset(folder, raw)
+    if indexed:
+        dataset = indexeddataset(dataset)
+    if distributed:
+        # Every process gets its own 1/world_size shard of each epoch.
+        sampler = DistributedSampler(dataset, shuffle=shuffle)
+    elif shuffle:
+        sampler = RandomSampler(dataset)
+    else:
+        sampler = SequentialSampler(dataset)
+    if not packed:
+        return DataLoader(
+            dataset,
+            batch_size=batch_size,
+            sampler=sampler,
+            num_workers=num_workers,
+            pin_memory=pin_memory,
+        )
+    return DataLoader(
+        dataset,
+        sampler=BatchSampler(sampler, batch_size, drop_last=False),
+        batch_size=None,
+        num_workers=min(num_workers, 2),
+        pin_memory=pin_memory,
+    )
+
+
+def set_epoch(loader, epoch):
+    # Reshuffles DistributedSampler shards, no-op for other samplers.
+    sampler = loader.sampler
+    sampler = getattr(sampler, "sampler", sampler)
+    if isinstance(sampler, DistributedSampler):
+        sampler.set_epoch(epoch)
+
+
+def get_train_data_loader(raw=False, distributed=False):
+    # Raw batches skip the per-image float conversion in the workers, so
+    # fewer of them keep up; wrap the loader in DevicePrefetcher.
+    return get_data_loader(
+        "data/train",
+        batch_size=64,
+        shuffle=True,
+        num_workers=4 if raw else 8,
+        raw=raw,
+        distributed=distributed,
+    )
 
 
 def get_test_data_loader():
-    dataset = selfdataset("data/test")
-    return DataLoader(dataset, batch_size=1, shuffle=True, num_workers=8)
+    return get_data_loader("data/test", batch_size=1, shuffle=True)
 
 
 def get_predict_data_loader():
-    dataset = selfdataset("data/valid")
-    return DataLoader(dataset, batch_size=1, shuffle=True, num_workers=8)
+    return get_data_loader("data/valid", batch_size=1, shuffle=True)
@@ -0,0 +1,211 @@
+import argparse
+import hashlib
+import json
+import os
+import time
+
+# Distillation is for the CPU-only daemons, keep it off any GPU.
+os.environ.setdefault("CUDA_VISIBLE_DEVICES", "")
+
+import torch
+import torch.nn.functional as F
+from tqdm import tqdm
+
+from dataset import get_data_loader, normalize, packeddataset
+from evaluate import evaluate, get_evaluate_data_loader
+from export import EXAMPLE_SHAPE
+from inference import MODEL_PATH, load_model
+from model import ARCHITECTURES, build
+from pack import packed_paths
+from utils.utils import logger
+
+CACHE_PATH = "model/teacher_logits.pt"
+TRAIN_FOLDER = "data/train"
+
+
+def get_distill_data_loader(shuffle):
+    return get_data_loader(
+        TRAIN_FOLDER, batch_size=64, shuffle=shuffle, raw=True, indexed=True
+    )
+
+
+def dataset_key(dataset):
+    # The cached logits are stored by index, so the key has to pin down which
+    # image sits at each index: the file order of a selfdataset (os.listdir)
+    # or the arrays written by pack.py (sorted) for a packeddataset.
+    if isinstance(dataset, packeddataset):
+        files = [
+            f"{path}:{os.path.getmtime(path)}" for path in packed_paths(TRAIN_FOLDER)
+        ]
+    else:
+        files = dataset.train_image_file_paths
+    return {
+        "dataset": type(dataset).__name__,
+        "size": len(dataset),
+        "files": hashlib.sha1("\n".join(files).encode()).hexdigest(),
+    }
+
+
+def outputs(model, images):
+    # (batch, 2, classes) logits from either head interface
+    return torch.stack(model(images), dim=1)
+
+
+@torch.inference_mode()
+def teacher_logits(teacher, path, cache=CACHE_PATH):
+    """Logits of the teacher for every training image, in dataset order.
+
+    The training images are not augmented, so they are the same every epoch:
+    computed once and kept in `cache` until the teacher or the data change.
+    """
+    key = {
+        "teacher": os.path.abspath(path),
+        "mtime": os.path.getmtime(path),
+        **dataset_key(get_distill_data_loader(False).dataset.dataset),
+    }
+    if cache and os.path.exists(cache):
+        state = torch.load(cache)
+        if state["key"] == key:
+            logger.info(f"Distill: Loaded teacher logits from {cache}")
+            return state["logits"]
+    start = time.perf_counter()
+    logits = torch.empty(key["size"], 2, 10)
+    for images, _, idx in tqdm(get_distill_data_loader(False)):
+        logits[idx] = outputs(teacher, normalize(images)).float()
+    logger.info(
+        f"Distill: Computed {key['size']} teacher logits "
+        f"in {time.perf_counter() - start:.1f}s"
+    )
+    if cache:
+        torch.save({"key": key, "logits": logits}, f"{cache}.tmp")
+        os.replace(f"{cache}.tmp", cache)
+    return logits
+
+
+def distillation_loss(student, teacher, labels, temperature, alpha):
+    # Hinton et al.: KL to the softened teacher, scaled by T^2 to keep its
+    # gradients comparable to the hard-label cross entropy.
+    soft = F.kl_div(
+        F.log_softmax(student / temperature, dim=2),
+        F.softmax(teacher / temperature, dim=2),
+        reduction="batchmean",
+    ) * (temperature**2)
+    hard = F.cross_entropy(student.flatten(0, 1), labels.flatten())
+    return alpha * soft + (1 - alpha) * hard
+
+
+@torch.inference_mode()
+def latency(model, runs=50):
+    x = torch.rand(EXAMPLE_SHAPE) * 2 - 1
+    model(x)  # warm up
+    latencies = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        model(x)
+        latencies.append(time.perf_counter() - start)
+    return sorted(latencies)[len(latencies) // 2]
+
+
+def report(teacher, student, path):
+    loader = get_evaluate_data_loader("data/test")
+    result = {
+        "student": student.arch,
+        "path": path,
+        "teacher_accuracy": evaluate(teacher, loader),
+        "student_accuracy": evaluate(student, loader),
+        "teacher_params": sum(p.numel() for p in teacher.parameters()),
+        "student_params": sum(p.numel() for p in student.parameters()),
+        "teacher_latency_ms": 1000 * latency(teacher),
+        "student_latency_ms": 1000 * latency(student),
+    }
+    result["accuracy_delta"] = result["student_accuracy"] - result["teacher_accuracy"]
+    result["speedup"] = result["teacher_latency_ms"] / result["student_latency_ms"]
+    logger.info(
+        f"Distill: {student.arch} {result['student_accuracy']:.2f}% vs teacher "
+        f"{result['teacher_accuracy']:.2f}% ({result['accuracy_delta']:+.2f} points), "
+        f"batch 1 {result['student_latency_ms']:.2f}ms vs "
+        f"{result['teacher_latency_ms']:.2f}ms ({result['speedup']:.1f}x faster), "
+        f"{result['student_params']} vs {result['teacher_params']} parameters"
+    )
+    with open(f"{os.path.splitext(path)[0]}.json", "w") as file:
+        json.dump(result, file, indent=4)
+    return result
+
+
+def main(
+    arch="mobilenet",
+    teacher_path=MODEL_PATH,
+    epochs=30,
+    temperature=4.0,
+    alpha=0.7,
+    learning_rate=0.003,
+    cache=CACHE_PATH,
+):
+    teacher = load_model(teacher_path)
+    student = build(arch)
+    path = f"model/{arch}.distilled.pkl"
+    logger.info(
+        f"Distill: {teacher_path} -> {arch} "
+        f"({sum(p.numel() for p in student.parameters())} parameters), "
+        f"T={temperature}, alpha={alpha}"
+    )
+    cached = teacher_logits(teacher, teacher_path, cache)
+    train_dataloader = get_distill_data_loader(True)
+    valid_dataloader = get_evaluate_data_loader("data/valid")
+    optimizer = torch.optim.Adam(student.parameters(), lr=learning_rate)
+    scheduler = torch.optim.lr_scheduler.CosineAnnealingLR(optimizer, epochs)
+    accuracy_best = -1
+    for epoch in range(epochs):
+        start = time.perf_counter()
+        student.train()
+        for images, labels, idx in tqdm(train_dataloader):
+            images, labels = normalize(images), labels.long()
+            optimizer.zero_grad()
+            if getattr(student, "ctc", False):
+                frames = student(images)
+                y = torch.stack(student.heads(frames), dim=1)
+                loss = 0.5 * student.loss(frames, labels) + distillation_loss(
+                    y, cached[idx], labels, temperature, alpha
+                )
+            else:
+                y = outputs(student, images)
+                loss = distillation_loss(y, cached[idx], labels, temperature, alpha)
+            loss.backward()
+            optimizer.step()
+        scheduler.step()
+        accuracy = evaluate(student, valid_dataloader)
+        logger.info(
+            f"epoch: {epoch}, loss: {loss.item()}, valid accuracy: {accuracy:.2f}%, "
+            f"time: {time.perf_counter() - start:.1f}s"
+        )
+        if accuracy > accuracy_best:
+            accuracy_best = accuracy
+            torch.save(student.state_dict(), path)
+            logger.info(f"Distill: Saved best student to {path} ({accuracy:.2f}%)")
+    student = load_model(path)
+    return report(teacher, student, path)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--arch", choices=ARCHITECTURES, default="mobilenet")
+    parser.add_argument("--teacher", default=MODEL_PATH)
+    parser.add_argument("--epochs", type=int, default=30)
+    parser.add_argument("--temperature", type=float, default=4.0)
+    parser.add_argument(
+        "--alpha", type=float, default=0.7, help="weight of the soft targets"
+    )
+    parser.add_argument("--lr", type=float, default=0.003)
+    parser.add_argument(
+        "--cache", default=CACHE_PATH, help="teacher logits file, '' to disable"
+    )
+    args = parser.parse_args()
+    main(
+        args.arch,
+        args.teacher,
+        args.epochs,
+        args.temperature,
+        args.alpha,
+        args.lr,
+        args.cache,
+    )
@@ -0,0 +1,44 @@
+import torch
+
+from dataset import DevicePrefetcher, get_data_loader
+from utils.utils import LabeltoStr, device
+
+
+def get_evaluate_data_loader(folder, batch_size=256):
+    return DevicePrefetcher(
+        get_data_loader(folder, batch_size, shuffle=False, num_workers=4, raw=True)
+    )
+
+
+@torch.inference_mode()
+def evaluate(model, loader, details=False):
+    """Exact-match accuracy (both digits right) of `model` on `loader`, in %.
+
+    With `details`, also returns a list of (expected, predicted) label strings.
+    """
+    # Frozen TorchScript modules (quantize.py) have no train/eval mode.
+    training = getattr(model, "training", None)
+    if training is not None:
+        model.eval()
+    memory_format = getattr(model, "memory_format", torch.contiguous_format)
+    correct = total = 0
+    results = []
+    for images, labels in loader:
+        labels = labels.to(device)
+        predict_label1, predict_label2 = model(
+            images.to(device, memory_format=memory_format)
+        )
+        predicted = torch.stack(
+            [predict_label1.argmax(dim=1), predict_label2.argmax(dim=1)], dim=1
+        )
+        correct += (predicted == labels).all(dim=1).sum().item()
+        total += labels.size(0)
+        if details:
+            results += [
+                (LabeltoStr(expect), LabeltoStr(predict))
+                for expect, predict in zip(labels.tolist(), predicted.tolist())
+            ]
+    if training is not None:
+        model.train(training)
+    accuracy = 100 * correct / total
+    return (accuracy, results) if details else accuracy
@@ -0,0 +1,83 @@
+import os
+import sys
+
+import numpy as np
+import torch
+from PIL import Image
+
+from dataset import transform
+from inference import (
+    MODEL_PATH,
+    SCRIPT_PATH,
+    OnnxModel,
+    forward,
+    load_model,
+    preprocess,
+)
+from utils.utils import device, logger
+
+# Captchas from cas.shmtu.edu.cn are 200x70 RGB
+EXAMPLE_SHAPE = (1, 3, 70, 200)
+
+
+def verify_onnx(model, onnx_model, folder="data/test", batch_size=32):
+    """Checks the ONNX model and the NumPy preprocessing against torch on `folder`."""
+    files = sorted(os.listdir(folder))
+    images, diff, agree = [], 0.0, 0
+    for name in files:
+        image = Image.open(os.path.join(folder, name))
+        images.append(preprocess(image))
+        np.testing.assert_allclose(images[-1], transform(image).numpy(), atol=1e-6)
+    for i in range(0, len(images), batch_size):
+        batch = np.stack(images[i : i + batch_size])
+        for expect, actual in zip(forward(model, batch), onnx_model(batch)):
+            diff = max(diff, float(np.abs(expect - actual).max()))
+            np.testing.assert_allclose(actual, expect, rtol=1e-3, atol=1e-3)
+            agree += int((expect.argmax(axis=1) == actual.argmax(axis=1)).sum())
+    logger.info(
+        f"Export: ONNX matches torch on {len(files)} images from {folder}, "
+        f"max logit difference {diff:.2e}, "
+        f"{100 * agree / (2 * len(files)):.2f}% of the digits agree"
+    )
+
+
+def export_onnx(src=MODEL_PATH, dst="model/best.onnx"):
+    model = load_model(src)
+    example = torch.rand(EXAMPLE_SHAPE, device=device) * 2 - 1
+    batch = {0: "batch"}
+    # The TorchScript-based exporter: the torch.export one needs onnxscript.
+    torch.onnx.export(
+        model,
+        (example,),
+        dst,
+        input_names=["images"],
+        output_names=["y1", "y2"],
+        dynamic_axes={"images": batch, "y1": batch, "y2": batch},
+        opset_version=17,
+        dynamo=False,
+    )
+    verify_onnx(model, OnnxModel(dst))
+    logger.info(f"Export: Saved ONNX model to {dst}")
+
+
+def export(src=MODEL_PATH, dst=SCRIPT_PATH):
+    if dst.endswith(".onnx"):
+        return export_onnx(src, dst)
+    model = load_model(src)
+    example = torch.rand(EXAMPLE_SHAPE, device=device) * 2 - 1
+    with torch.inference_mode():
+        traced = torch.jit.trace(model, example)
+    # Freezing inlines the weights, folds every BatchNorm into the preceding
+    # Conv and drops the Dropout, which is a no-op in eval mode anyway.
+    frozen = torch.jit.freeze(traced)
+    with torch.inference_mode():
+        for batch in (1, 8):
+            x = torch.rand((batch,) + EXAMPLE_SHAPE[1:], device=device) * 2 - 1
+            for expect, actual in zip(model(x), frozen(x)):
+                torch.testing.assert_close(actual, expect, rtol=1e-4, atol=1e-4)
+    torch.jit.save(frozen, dst)
+    logger.info(f"Export: Saved frozen TorchScript model to {dst}")
+
+
+if __name__ == "__main__":
+    export(*sys.argv[1:3])
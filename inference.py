@@ -0,0 +1,483 @@
+import asyncio
+import collections
+import gc
+import hashlib
+import importlib.util
+import os
+import queue
+import threading
+import time
+from collections import namedtuple
+from concurrent.futures import Future, ThreadPoolExecutor
+from io import BytesIO
+
+from PIL import Image
+
+from utils.metrics import Counter, Histogram
+from utils.utils import LabeltoStr, logger
+
+# Heavy modules are imported on first use: numpy with the first captcha,
+# torch only to load and run torch models. With an ONNX model (export.py
+# model/best.pkl model/best.onnx) the daemons run without torch.
+MODEL_PATH = "model/best.pkl"
+SCRIPT_PATH = "model/best.ts"
+INT8_PATH = "model/best.int8.ts"
+ONNX_PATH = "model/best.onnx"
+PRECISIONS = ("fp32", "int8", "channels_last", "onnx")
+CAPTCHA_SHAPE = (3, 70, 200)  # 200x70 RGB
+MAX_BATCH_SIZE = 32
+MAX_WAIT = 0.005  # seconds to wait for more captchas before running a batch
+WORKERS = 1
+MIN_CONFIDENCE = 0.9  # refetch the captcha rather than submit a guess below this
+MAX_REFETCH = 3
+CACHE_SIZE = 1024  # captchas, 0 turns the cache off
+CACHE_TTL = 600  # seconds
+
+Prediction = namedtuple("Prediction", ["label", "confidence", "probabilities"])
+
+
+class OnnxModel:
+    """A model exported to ONNX, run with onnxruntime on CPU.
+
+    Called with a float32 NumPy batch, returns both heads as NumPy arrays.
+    """
+
+    def __init__(self, path, num_threads=None):
+        self.path = path
+        self.num_threads = None
+        self.set_num_threads(num_threads or os.cpu_count() or 1)
+
+    def set_num_threads(self, num_threads):
+        import onnxruntime
+
+        if num_threads == self.num_threads:
+            return
+        options = onnxruntime.SessionOptions()
+        options.intra_op_num_threads = num_threads
+        options.inter_op_num_threads = 1
+        self.session = onnxruntime.InferenceSession(
+            self.path, options, providers=["CPUExecutionProvider"]
+        )
+        self.input = self.session.get_inputs()[0].name
+        self.num_threads = num_threads
+
+    def __call__(self, images):
+        return tuple(self.session.run(None, {self.input: images}))
+
+
+def has_torch():
+    return importlib.util.find_spec("torch") is not None
+
+
+def default_path():
+    # Prefer the frozen TorchScript export (see export.py), unless it is older
+    # than the weights, e.g. after a retrain without exporting again.
+    if not os.path.exists(SCRIPT_PATH):
+        return MODEL_PATH
+    stale = os.path.exists(MODEL_PATH) and (
+        os.path.getmtime(SCRIPT_PATH) < os.path.getmtime(MODEL_PATH)
+    )
+    if stale:
+        logger.warning(
+            f"Detect: {SCRIPT_PATH} is older than {MODEL_PATH}, loading the "
+            f"latter; run export.py to update it"
+        )
+        return MODEL_PATH
+    return SCRIPT_PATH
+
+
+def load_model(path=None, precision="fp32"):
+    if precision not in PRECISIONS:
+        raise ValueError(f"Unknown precision {precision}, expected one of {PRECISIONS}")
+    if path is None and precision == "fp32" and not has_torch():
+        precision = "onnx"
+    if precision == "onnx" or (path and path.endswith(".onnx")):
+        path = path or ONNX_PATH
+        model = OnnxModel(path)
+        logger.info(f"Detect: Loaded {path} (onnx)")
+        return model
+
+    import torch
+
+    from model import from_state_dict
+    from utils.utils import device
+
+    if precision == "int8":
+        # Quantized kernels only exist for CPU, see quantize.py
+        if device.type != "cpu":
+            raise ValueError("int8 models only run on CPU")
+        path = path or INT8_PATH
+    elif precision == "channels_last":
+        path = path or MODEL_PATH
+    elif path is None:
+        path = default_path()
+    if path.endswith(".ts"):
+        model = torch.jit.load(path, map_location=device)
+    else:
+        model = from_state_dict(torch.load(path, map_location=device))
+        model.to(device)
+        if precision == "channels_last":
+            model.to(memory_format=torch.channels_last)
+            model.memory_format = torch.channels_last
+    model.eval()
+    logger.info(f"Detect: Loaded {path} ({precision})")
+    return model
+
+
+def load_models(paths=(None,), precision="fp32"):
+    return [load_model(path, precision) for path in paths]
+
+
+def preprocess(Img):
+    import numpy as np
+
+    # dataset.transform in NumPy: ToTensor (HWC -> CHW, /255), Normalize(0.5, 0.5)
+    image = np.asarray(Img.convert("RGB"), dtype=np.float32).transpose(2, 0, 1)
+    return (image / 255 - 0.5) / 0.5
+
+
+def forward(model, images):
+    """Both heads of `model` for a float32 NumPy batch, as NumPy arrays."""
+    if isinstance(model, OnnxModel):
+        return model(images)
+    import torch
+
+    from utils.utils import device
+
+    memory_format = getattr(model, "memory_format", torch.contiguous_format)
+    with torch.inference_mode():
+        heads = model(
+            torch.from_numpy(images).to(device).contiguous(memory_format=memory_format)
+        )
+    return tuple(head.float().cpu().numpy() for head in heads)
+
+
+def softmax(x):
+    import numpy as np
+
+    x = np.exp(x - x.max(axis=1, keepdims=True))
+    return x / x.sum(axis=1, keepdims=True)
+
+
+def predict(model, images):
+    return [
+        prediction.label
+        for prediction in to_predictions(predict_probabilities([model], images))
+    ]
+
+
+def predict_probabilities(models, images, shifts=()):
+    """Per-digit softmax of `images`, shape (batch, 2, classes).
+
+    Averaged over every model in `models` and, for test-time augmentation,
+    over copies of the images shifted horizontally by each of `shifts` pixels.
+    """
+    import numpy as np
+
+    views = [images] + [np.roll(images, shift, axis=3) for shift in shifts]
+    probabilities = 0
+    for model in models:
+        for view in views:
+            predict_label1, predict_label2 = forward(model, view)
+            probabilities = probabilities + np.stack(
+                [softmax(predict_label1), softmax(predict_label2)], axis=1
+            )
+    return probabilities / (len(models) * len(views))
+
+
+def to_predictions(probabilities):
+    label = probabilities.argmax(axis=2)
+    # Both digits have to be right, so the label is as likely as their product.
+    confidence = probabilities.max(axis=2).prod(axis=1)
+    return [
+        Prediction(LabeltoStr(digits), score, p)
+        for digits, score, p in zip(label.tolist(), confidence.tolist(), probabilities)
+    ]
+
+
+class CaptchaCache:
+    """Predictions of recently seen captchas, keyed by a hash of their bytes.
+
+    CAS sometimes serves byte-identical captchas, to a retry or to accounts
+    logging in within the same minute, and those skip the model. Entries expire
+    `ttl` seconds after they were stored, and beyond `max_size` the least
+    recently used go first.
+    """
+
+    def __init__(self, max_size=CACHE_SIZE, ttl=CACHE_TTL):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.entries = collections.OrderedDict()  # key -> (expires, prediction)
+        self.lock = threading.Lock()
+        self.events = Counter(
+            "captcha_cache_total", "event", "Captcha cache lookups and removals"
+        )
+
+    @staticmethod
+    def key(data):
+        return hashlib.blake2b(data, digest_size=16).digest()
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                event, prediction = "miss", None
+            elif entry[0] <= time.monotonic():
+                del self.entries[key]
+                event, prediction = "expired", None
+            else:
+                self.entries.move_to_end(key)
+                event, prediction = "hit", entry[1]
+        self.events.inc(event)
+        return prediction
+
+    def put(self, key, prediction):
+        with self.lock:
+            self.entries[key] = (time.monotonic() + self.ttl, prediction)
+            self.entries.move_to_end(key)
+            evicted = max(0, len(self.entries) - self.max_size)
+            for _ in range(evicted):
+                self.entries.popitem(last=False)
+        if evicted:
+            self.events.inc("evicted", evicted)
+
+    def invalidate(self, key):
+        with self.lock:
+            removed = self.entries.pop(key, None) is not None
+        if removed:
+            self.events.inc("invalidated")
+        return removed
+
+    def __len__(self):
+        return len(self.entries)
+
+    def summary(self):
+        return f"{self.events.summary()}, size={len(self)}/{self.max_size}"
+
+
+class BatchPredictor:
+    """Micro-batching captcha solver shared by the check-in daemons.
+
+    Callers submit a PIL image and wait on a future. A collector thread gathers
+    pending captchas for up to `max_wait` seconds or `max_batch_size` images
+    and hands each batch to a pool of `workers` threads, so at most `workers`
+    forward passes run at once and each gets an equal share of the cores.
+
+    `model` may be a list of models, whose probabilities are averaged, and
+    `shifts` turns on test-time augmentation (see predict_probabilities).
+    Futures resolve to a Prediction; the login flows refetch the captcha
+    while its confidence is below `min_confidence`, up to `max_refetch` times.
+
+    Instead of `model`, `loader` returns the model(s) when the first captcha
+    arrives (or on warm_up()). The models are then released again after
+    `release_after` seconds without a captcha, if set.
+
+    Captchas may be PIL images or the raw bytes from CAS. With a `cache`
+    (CaptchaCache), bytes seen before get the stored prediction, and the login
+    flows invalidate() the captcha when its prediction turns out wrong.
+    """
+
+    def __init__(
+        self,
+        model=None,
+        max_batch_size=MAX_BATCH_SIZE,
+        max_wait=MAX_WAIT,
+        workers=WORKERS,
+        num_threads=None,
+        shifts=(),
+        min_confidence=MIN_CONFIDENCE,
+        max_refetch=MAX_REFETCH,
+        loader=None,
+        release_after=None,
+        cache=None,
+    ):
+        self.loader = loader
+        self.cache = cache
+        self.release_after = release_after if loader else None
+        self.models = None
+        self.lock = threading.Lock()
+        self.shifts = tuple(shifts)
+        self.min_confidence = min_confidence
+        self.max_refetch = max_refetch
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.threads = num_threads or max(1, (os.cpu_count() or 1) // workers)
+        if model is not None:
+            self.set_models(model)
+        self.executor = ThreadPoolExecutor(workers, thread_name_prefix="Inference")
+        self.slots = threading.Semaphore(workers)
+        self.requests = queue.Queue()
+        self.batch_size = Histogram("captcha_batch_size", [1, 2, 4, 8, 16, 32, 64, 128])
+        self.queue_wait = Histogram(
+            "captcha_queue_wait_seconds", [0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5]
+        )
+        self.confidence = Histogram(
+            "captcha_confidence", [0.5, 0.7, 0.8, 0.9, 0.95, 0.99, 0.999, 1]
+        )
+        self.inference = Histogram(
+            "captcha_inference_seconds", [0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1]
+        )
+        self.collector = threading.Thread(
+            target=self.run, name="BatchPredictor", daemon=True
+        )
+        self.collector.start()
+        logger.info(f"Detect: {workers} inference workers x {self.threads} threads")
+
+    def set_models(self, model):
+        models = list(model) if isinstance(model, (list, tuple)) else [model]
+        for model in models:
+            if isinstance(model, OnnxModel):
+                model.set_num_threads(self.threads)
+        if not all(isinstance(model, OnnxModel) for model in models):
+            import torch
+
+            torch.set_num_threads(self.threads)
+        self.models = models
+
+    def load(self):
+        models = self.models
+        if models is None:
+            with self.lock:
+                if self.models is None:
+                    start = time.perf_counter()
+                    self.set_models(self.loader())
+                    logger.info(
+                        f"Detect: Loaded {len(self.models)} models "
+                        f"in {time.perf_counter() - start:.2f}s"
+                    )
+                models = self.models
+        return models
+
+    def warm_up(self):
+        # The first forward pass also allocates buffers and picks kernels.
+        import numpy as np
+
+        start = time.perf_counter()
+        predict_probabilities(
+            self.load(), np.zeros((1,) + CAPTCHA_SHAPE, np.float32), self.shifts
+        )
+        logger.info(f"Detect: Warmed up in {time.perf_counter() - start:.2f}s")
+
+    def release(self):
+        if self.loader is None or self.models is None:
+            return
+        with self.lock:
+            self.models = None
+        gc.collect()
+        logger.info("Detect: Released the models until the next captcha")
+
+    def submit(self, Img):
+        if isinstance(Img, bytes):
+            Img = Image.open(BytesIO(Img))
+        future = Future()
+        self.requests.put((time.perf_counter(), preprocess(Img), future))
+        return future
+
+    def lookup(self, Img):
+        # (cache key, cached prediction), both None unless cacheable bytes
+        if self.cache is None or not isinstance(Img, bytes):
+            return None, None
+        key = self.cache.key(Img)
+        return key, self.cache.get(key)
+
+    def result(self, key, prediction, cached=False):
+        if key is not None and not cached:
+            self.cache.put(key, prediction)
+        logger.info(
+            f"Detect: Result {prediction.label} ({prediction.confidence:.3f}"
+            f"{', cached' if cached else ''})"
+        )
+        return prediction
+
+    def detect(self, Img):
+        logger.info(f"Detect: Detecting...")
+        key, prediction = self.lookup(Img)
+        if prediction is not None:
+            return self.result(key, prediction, cached=True)
+        return self.result(key, self.submit(Img).result())
+
+    async def detect_async(self, Img):
+        logger.info(f"Detect: Detecting...")
+        key, prediction = self.lookup(Img)
+        if prediction is not None:
+            return self.result(key, prediction, cached=True)
+        # Decoding and normalizing the captcha is CPU work too, keep it off the loop.
+        future = await asyncio.get_running_loop().run_in_executor(
+            None, self.submit, Img
+        )
+        return self.result(key, await asyncio.wrap_future(future))
+
+    def invalidate(self, Img):
+        # The login with this captcha's prediction failed, don't reuse it.
+        if self.cache is not None and isinstance(Img, bytes):
+            self.cache.invalidate(self.cache.key(Img))
+
+    def report(self):
+        logger.info(f"Detect: {self.batch_size.summary()}")
+        logger.info(f"Detect: {self.queue_wait.summary()}")
+        logger.info(f"Detect: {self.confidence.summary()}")
+        logger.info(f"Detect: {self.inference.summary()}")
+        if self.cache is not None:
+            logger.info(f"Detect: {self.cache.summary()}")
+
+    def collect(self):
+        while True:
+            try:
+                batch = [self.requests.get(timeout=self.release_after)]
+                break
+            except queue.Empty:
+                self.release()
+        deadline = time.perf_counter() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            timeout = deadline - time.perf_counter()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(self.requests.get(timeout=timeout))
+            except queue.Empty:
+                break
+        return batch
+
+    def process(self, batch):
+        import numpy as np
+
+        # Waiters that timed out have cancelled their futures, skip those. The
+        # others can't be cancelled from here on, so setting them is safe.
+        batch = [
+            request for request in batch if request[2].set_running_or_notify_cancel()
+        ]
+        try:
+            if not batch:
+                return
+            models = self.load()
+            start = time.perf_counter()
+            predictions = to_predictions(
+                predict_probabilities(
+                    models,
+                    np.stack([image for _, image, _ in batch]),
+                    self.shifts,
+                )
+            )
+        except Exception as e:
+            logger.exception(f"Detect: Batch of {len(batch)} failed")
+            for _, _, future in batch:
+                future.set_exception(e)
+            return
+        finally:
+            self.slots.release()
+        self.inference.observe(time.perf_counter() - start)
+        for (_, _, future), prediction in zip(batch, predictions):
+            self.confidence.observe(prediction.confidence)
+            future.set_result(prediction)
+
+    def run(self):
+        while True:
+            # Wait for a free worker first, so captchas keep queueing (and the
+            # next batch grows) while every worker is busy.
+            self.slots.acquire()
+            batch = self.collect()
+            start = time.perf_counter()
+            for enqueued, _, _ in batch:
+                self.queue_wait.observe(start - enqueued)
+            self.batch_size.observe(len(batch))
+            self.executor.submit(self.process, batch)
@@ -88,21 +88,22 @@ class ResidualBlock(nn.Module):
 
 
 class ResNet(nn.Module):
-    def __init__(self, ResidualBlock, num_classes=10):
+    def __init__(self, ResidualBlock, num_classes=10, widths=(64, 128, 256, 512)):
         super().__init__()
-        self.inchannel = 64
+        self.inchannel = widths[0]
         self.conv1 = nn.Sequential(
-            nn.Conv2d(3, 64, kernel_size=3, stride=1, padding=1, bias=False),
-            nn.BatchNorm2d(64, track_running_stats=True),
+            nn.Conv2d(3, widths[0], kernel_size=3, stride=1, padding=1, bias=False),
+            nn.BatchNorm2d(widths[0], track_running_stats=True),
             nn.ReLU(),
         )
-        self.layer1 = self.make_layer(ResidualBlock, 64, 2, stride=1)
-        self.layer2 = self.make_layer(ResidualBlock, 128, 2, stride=2)
-        self.layer3 = self.make_layer(ResidualBlock, 256, 2, stride=2)
-        self.layer4 = self.make_layer(ResidualBlock, 512, 2, stride=2)
+        self.layer1 = self.make_layer(ResidualBlock, widths[0], 2, stride=1)
+        self.layer2 = self.make_layer(ResidualBlock, widths[1], 2, stride=2)
+        self.layer3 = self.make_layer(ResidualBlock, widths[2], 2, stride=2)
+        self.layer4 = self.make_layer(ResidualBlock, widths[3], 2, stride=2)
+        self.pool = nn.AdaptiveAvgPool2d(1)
         self.drop = nn.Dropout(0.5)
-        self.fc1 = nn.Linear(512, num_classes)
-        self.fc2 = nn.Linear(512, num_classes)
+        self.fc1 = nn.Linear(widths[3], num_classes)
+        self.fc2 = nn.Linear(widths[3], num_classes)
 
     def make_layer(self, block, channels, num_blocks, stride):
         strides = [stride] + [1] * (num_blocks - 1)
@@ -118,8 +119,8 @@ class ResNet(nn.Module):
         x = self.layer2(x)  # -> [128, 16, 16] -> [128, 16, 16], floor in conv2d
         x = self.layer3(x)  # -> [256, 8, 8] -> [256, 8, 8]
         x = self.layer4(x)  # -> [512, 4, 4] -> [512, 4, 4]
-        x = nn.AdaptiveAvgPool2d(1)(x)
-        x = x.view(-1, 512)
+        x = self.pool(x)
+        x = x.flatten(1)
         x = self.drop(x)
         y1 = self.fc1(x)  # -> [1, 10]
         y2 = self.fc2(x)
@@ -134,3 +135,154 @@ class ResNet(nn.Module):
             name = "./model/resNet_last.pkl"
             self.load_state_dict(torch.load(name, map_location=device))
             logger.info("ResNet Model: The latest model has been loaded.")
+
+
+# MobileNet-style: a depthwise 3x3 conv per channel, then a pointwise 1x1 conv
+# mixing the channels, about 8x fewer multiply-adds than a full 3x3 conv.
+class DepthwiseSeparableBlock(nn.Module):
+    def __init__(self, inchannel, outchannel, stride=1):
+        super().__init__()
+        self.depthwise = nn.Sequential(
+            nn.Conv2d(
+                inchannel,
+                inchannel,
+                kernel_size=3,
+                stride=stride,
+                padding=1,
+                groups=inchannel,
+                bias=False,
+            ),
+            nn.BatchNorm2d(inchannel),
+            nn.ReLU(inplace=True),
+        )
+        self.pointwise = nn.Sequential(
+            nn.Conv2d(inchannel, outchannel, kernel_size=1, bias=False),
+            nn.BatchNorm2d(outchannel),
+            nn.ReLU(inplace=True),
+        )
+
+    def forward(self, x):
+        return self.pointwise(self.depthwise(x))
+
+
+class MobileNet(nn.Module):
+    def __init__(self, num_classes=10, widths=(16, 32, 64, 128)):
+        super().__init__()
+        self.conv1 = nn.Sequential(
+            nn.Conv2d(3, widths[0], kernel_size=3, stride=2, padding=1, bias=False),
+            nn.BatchNorm2d(widths[0]),
+            nn.ReLU(inplace=True),
+        )
+        layers = []
+        for inchannel, outchannel in zip(widths, widths[1:]):
+            layers.append(DepthwiseSeparableBlock(inchannel, outchannel, stride=2))
+            layers.append(DepthwiseSeparableBlock(outchannel, outchannel))
+        self.layers = nn.Sequential(*layers)
+        self.pool = nn.AdaptiveAvgPool2d(1)
+        self.drop = nn.Dropout(0.2)
+        self.fc1 = nn.Linear(widths[-1], num_classes)
+        self.fc2 = nn.Linear(widths[-1], num_classes)
+
+    def forward(self, x):
+        x = self.conv1(x)  # [3, 70, 200] -> [16, 35, 100]
+        x = self.layers(x)  # -> [128, 5, 13]
+        x = self.pool(x).flatten(1)
+        x = self.drop(x)
+        return self.fc1(x), self.fc2(x)
+
+
+# CRNN: conv features per image column, a bidirectional GRU over the columns
+# and CTC over 10 digits + blank, so any number of digits can be read.
+class CRNN(nn.Module):
+    ctc = True
+
+    def __init__(self, num_classes=10, widths=(32, 64, 128), hidden=64, digits=2):
+        super().__init__()
+        layers = []
+        for inchannel, outchannel in zip((3,) + tuple(widths), widths):
+            layers += [
+                nn.Conv2d(inchannel, outchannel, kernel_size=3, padding=1, bias=False),
+                nn.BatchNorm2d(outchannel),
+                nn.ReLU(inplace=True),
+                nn.MaxPool2d(2),
+            ]
+        self.features = nn.Sequential(*layers)
+        self.pool = nn.AdaptiveAvgPool2d((1, None))
+        self.rnn = nn.GRU(widths[-1], hidden, batch_first=True, bidirectional=True)
+        self.fc = nn.Linear(2 * hidden, num_classes + 1)  # class 0 is the blank
+        self.digits = digits
+
+    def frames(self, x):
+        x = self.features(x)  # [3, 70, 200] -> [128, 8, 25]
+        x = self.pool(x).squeeze(2).transpose(1, 2)  # -> [25, 128]
+        x, _ = self.rnn(x)
+        return self.fc(x)  # -> [25, 11]
+
+    def forward(self, x):
+        # Training needs every frame for the CTC loss, everything else reads
+        # the two-head output like the other models.
+        frames = self.frames(x)
+        return frames if self.training else self.heads(frames)
+
+    def loss(self, frames, labels):
+        log_probs = frames.float().log_softmax(dim=2).transpose(0, 1)
+        lengths = torch.full((frames.size(0),), frames.size(1), dtype=torch.long)
+        target_lengths = torch.full((labels.size(0),), labels.size(1), dtype=torch.long)
+        return F.ctc_loss(log_probs, labels + 1, lengths, target_lengths)
+
+    def heads(self, frames):
+        # Greedy CTC decoding as `digits` heads: digit k is read from the frame
+        # that starts the k-th run of a non-blank class. Tensor ops only, so
+        # it traces for export.py.
+        probabilities = frames.softmax(dim=2)
+        best = probabilities.argmax(dim=2)
+        starts = (best != 0) & (best != F.pad(best[:, :-1], (1, 0)))
+        order = starts.cumsum(dim=1)
+        heads = []
+        for k in range(1, self.digits + 1):
+            mask = (starts & (order == k)).unsqueeze(2).to(probabilities.dtype)
+            digit = (mask * probabilities[:, :, 1:]).sum(dim=1)
+            # A missing digit is a uniform guess, so its confidence is low.
+            missing = 1 - mask.amax(dim=1)
+            heads.append(torch.log(digit + missing / digit.size(1) + 1e-8))
+        return tuple(heads)
+
+    @torch.no_grad()
+    def decode(self, x):
+        # Variable length reading: every digit, not just the first `digits`.
+        labels = []
+        for best in self.frames(x).argmax(dim=2).tolist():
+            digits = [c for c, p in zip(best, [0] + best) if c and c != p]
+            labels.append("".join(str(c - 1) for c in digits))
+        return labels
+
+
+ARCHITECTURES = {
+    "resnet18": lambda: ResNet(ResidualBlock),
+    "resnet_slim": lambda: ResNet(ResidualBlock, widths=(16, 32, 64, 128)),
+    "resnet_tiny": lambda: ResNet(ResidualBlock, widths=(8, 16, 32, 64)),
+    "mobilenet": lambda: MobileNet(),
+    "crnn": lambda: CRNN(),
+}
+DEFAULT_ARCH = "resnet18"
+
+
+def build(arch=DEFAULT_ARCH):
+    if arch not in ARCHITECTURES:
+        raise ValueError(
+            f"Unknown architecture {arch}, expected one of {list(ARCHITECTURES)}"
+        )
+    model = ARCHITECTURES[arch]()
+    model.arch = arch
+    return model
+
+
+def from_state_dict(state):
+    """Builds whichever architecture `state` was saved from and loads it."""
+    shapes = {key: value.shape for key, value in state.items()}
+    for arch in ARCHITECTURES:
+        model = build(arch)
+        if {key: value.shape for key, value in model.state_dict().items()} == shapes:
+            model.load_state_dict(state)
+            return model
+    raise ValueError("The weights match none of the architectures in model.py")
@@ -0,0 +1,71 @@
+import json
+import os
+import sys
+
+import numpy as np
+from PIL import Image
+
+from utils.utils import StrtoLabel, logger
+
+SPLITS = ("data/train", "data/test", "data/valid")
+
+
+def packed_paths(folder):
+    head, split = os.path.split(os.path.normpath(folder))
+    root = os.path.join(head, "packed", split)
+    return f"{root}_images.npy", f"{root}_labels.npy"
+
+
+def meta_path(folder):
+    return packed_paths(folder)[0].replace("_images.npy", ".json")
+
+
+def fingerprint(folder):
+    # Adding, removing or renaming (relabelling) an image changes the folder's
+    # mtime, rewriting one changes its own.
+    entries = list(os.scandir(folder))
+    mtime = max([os.stat(folder).st_mtime] + [e.stat().st_mtime for e in entries])
+    return {"files": len(entries), "mtime": mtime}
+
+
+def is_packed(folder):
+    """Whether pack.py's arrays exist for `folder` and are still up to date."""
+    if not all(map(os.path.exists, packed_paths(folder))):
+        return False
+    try:
+        with open(meta_path(folder)) as file:
+            fresh = json.load(file) == fingerprint(folder)
+    except (FileNotFoundError, ValueError):
+        fresh = False
+    if not fresh:
+        logger.warning(
+            f"Pack: The packed copy of {folder} is out of date, reading the "
+            f"images instead; run python pack.py {folder} again"
+        )
+    return fresh
+
+
+def pack(folder):
+    image_path, label_path = packed_paths(folder)
+    os.makedirs(os.path.dirname(image_path), exist_ok=True)
+    names = sorted(os.listdir(folder))
+    width, height = Image.open(os.path.join(folder, names[0])).size
+    # Written through a memmap so the whole split never has to fit in memory.
+    images = np.lib.format.open_memmap(
+        image_path, mode="w+", dtype=np.uint8, shape=(len(names), 3, height, width)
+    )
+    labels = np.empty((len(names), 2), dtype=np.int64)
+    for i, name in enumerate(names):
+        image = Image.open(os.path.join(folder, name)).convert("RGB")
+        images[i] = np.asarray(image).transpose(2, 0, 1)
+        labels[i] = StrtoLabel(name.split("_")[0])
+    images.flush()
+    np.save(label_path, labels)
+    with open(meta_path(folder), "w") as file:
+        json.dump(fingerprint(folder), file)
+    logger.info(f"Pack: {len(names)} images from {folder} -> {image_path}")
+
+
+if __name__ == "__main__":
+    for folder in sys.argv[1:] or SPLITS:
+        pack(folder)
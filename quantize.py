@@ -0,0 +1,66 @@
+import argparse
+import copy
+
+import torch
+from torch.ao.quantization import get_default_qconfig_mapping
+from torch.ao.quantization.quantize_fx import convert_fx, prepare_fx
+from torch.utils.data import DataLoader
+
+from dataset import selfdataset
+from evaluate import evaluate, get_evaluate_data_loader
+from export import EXAMPLE_SHAPE
+from inference import INT8_PATH, MODEL_PATH, load_model
+from utils.utils import logger
+
+
+def quantize(model, calibrate_loader, backend):
+    torch.backends.quantized.engine = backend
+    example = (torch.rand(EXAMPLE_SHAPE) * 2 - 1,)
+    # prepare_fx fuses Conv-BN-ReLU (and the residual add-ReLU) in every
+    # ResidualBlock before inserting the observers.
+    prepared = prepare_fx(
+        copy.deepcopy(model), get_default_qconfig_mapping(backend), example
+    )
+    with torch.inference_mode():
+        for images, _ in calibrate_loader:
+            prepared(images)
+    quantized = convert_fx(prepared)
+    with torch.inference_mode():
+        return torch.jit.freeze(torch.jit.trace(quantized, example))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("src", nargs="?", default=MODEL_PATH)
+    parser.add_argument("dst", nargs="?", default=INT8_PATH)
+    parser.add_argument("--calibrate", default="data/valid")
+    parser.add_argument("--test", default="data/test")
+    parser.add_argument(
+        "--max-drop",
+        type=float,
+        default=0.5,
+        help="refuse to save if test accuracy drops by more than this many points",
+    )
+    parser.add_argument(
+        "--backend", default="x86", choices=torch.backends.quantized.supported_engines
+    )
+    args = parser.parse_args()
+
+    model = load_model(args.src)
+    calibrate_loader = DataLoader(selfdataset(args.calibrate), batch_size=32)
+    test_loader = get_evaluate_data_loader(args.test)
+    quantized = quantize(model, calibrate_loader, args.backend)
+    fp32_acc, int8_acc = evaluate(model, test_loader), evaluate(quantized, test_loader)
+    logger.info(f"Quantize: Accuracy fp32 {fp32_acc:.2f}%, int8 {int8_acc:.2f}%")
+    if fp32_acc - int8_acc > args.max_drop:
+        logger.error(
+            f"Quantize: Accuracy dropped by more than {args.max_drop} points, "
+            f"not saving {args.dst}"
+        )
+        raise SystemExit(1)
+    torch.jit.save(quantized, args.dst)
+    logger.info(f"Quantize: Saved int8 model to {args.dst}")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,40 +1,22 @@
 # -*- coding: UTF-8 -*-
-import numpy as np
-import torch
-from tqdm import tqdm
+import sys
 
-from dataset import get_test_data_loader
-from model import ResidualBlock, ResNet
-from utils.utils import LabeltoStr, StrtoLabel, device, logger
+from evaluate import evaluate, get_evaluate_data_loader
+from inference import MODEL_PATH, load_model
+from utils.utils import logger
 
 
-def main():
-    model = ResNet(ResidualBlock)
-    model.eval()
-    model.load_state_dict(torch.load("model/best.pkl", map_location=device))
+def main(path=MODEL_PATH):
+    model = load_model(path)
     logger.info("Test: loaded model")
 
-    test_dataloader = get_test_data_loader()
+    test_dataloader = get_evaluate_data_loader("data/test")
 
-    correct = 0
-    total = 0
-    for i, (images, labels) in enumerate(tqdm(test_dataloader)):
-        images = images.to(device)
-        predict_label1, predict_label2 = model(images)
-        predict_label = LabeltoStr(
-            [
-                np.argmax(predict_label1.data.numpy()[0]),
-                np.argmax(predict_label2.data.numpy()[0]),
-            ]
-        )
-        true_label = LabeltoStr(labels.data.numpy()[0])
-        total += labels.size(0)
-        if predict_label == true_label:
-            correct += 1
+    accuracy = evaluate(model, test_dataloader)
     logger.info(
-        f"Test finished! Accuracy on {total} test images: {100 * correct / total}%"
+        f"Test finished! Accuracy on {len(test_dataloader.loader.dataset)} test images: {accuracy}%"
     )
 
 
 if __name__ == "__main__":
-    main()
+    main(*sys.argv[1:2])
@@ -1,8 +1,17 @@
+import argparse
+import math
+import os
+import time
+
 import torch
+import torch.distributed as dist
+from torch.nn.parallel import DistributedDataParallel
 from tqdm import tqdm
 
-from dataset import get_train_data_loader
-from model import ResidualBlock, ResNet
+from dataset import DevicePrefetcher, get_train_data_loader, set_epoch
+from evaluate import evaluate, get_evaluate_data_loader
+from model import ARCHITECTURES, DEFAULT_ARCH, build
+from utils.checkpoint import CheckpointManager
 from utils.scheduler import GradualWarmupScheduler
 from utils.utils import device, logger
 
@@ -10,48 +19,245 @@ from utils.utils import device, logger
 num_epochs = 100
 learning_rate = 0.001
 
+PRECISIONS = {"fp32": torch.float32, "bf16": torch.bfloat16, "fp16": torch.float16}
+
+
+def setup_distributed():
+    """Joins the process group when started by torchrun.
+
+    Returns (rank, world_size), (0, 1) for a plain `python train.py`.
+    """
+    world_size = int(os.environ.get("WORLD_SIZE", 1))
+    if device.type == "cpu" and "LOCAL_WORLD_SIZE" in os.environ:
+        # torchrun pins OMP_NUM_THREADS to 1, share the cores between the
+        # processes on this machine instead.
+        local_world_size = int(os.environ["LOCAL_WORLD_SIZE"])
+        torch.set_num_threads(max(1, (os.cpu_count() or 1) // local_world_size))
+    if world_size == 1:
+        return 0, 1
+    if device.type == "cuda":
+        torch.cuda.set_device(device)
+        dist.init_process_group("nccl")
+    else:
+        dist.init_process_group("gloo")
+    return dist.get_rank(), world_size
+
+
+def warmup_multiplier(world_size):
+    # The global batch is world_size times larger. The linear scaling rule is
+    # for SGD, with Adam scale the learning rate by the square root instead.
+    return 8 * math.sqrt(world_size)
+
+
+def rescale_warmup(scheduler, optimizer, multiplier):
+    """Switches a resumed warm-up to `multiplier`, e.g. for another world size."""
+
+    def factor(m):
+        epoch = min(scheduler.last_epoch, scheduler.total_epoch)
+        return (m - 1) * epoch / scheduler.total_epoch + 1
+
+    scale = factor(multiplier) / factor(scheduler.multiplier)
+    logger.info(
+        f"Train: Warm-up multiplier {scheduler.multiplier:g} -> {multiplier:g}, "
+        f"learning rate x{scale:.3g}"
+    )
+    scheduler.multiplier = multiplier
+    for group in optimizer.param_groups:
+        group["lr"] *= scale
+    if scheduler.finished:
+        after = scheduler.after_scheduler
+        after.base_lrs = [lr * scale for lr in after.base_lrs]
+
 
-def main():
-    model = ResNet(ResidualBlock).to(device)
-    model.reload()
+def broadcast(value):
+    tensor = torch.tensor([value], dtype=torch.float64, device=device)
+    dist.broadcast(tensor, 0)
+    return tensor.item()
+
+
+def main(
+    precision="fp32",
+    compile=False,
+    target_accuracy=99.0,
+    keep=3,
+    patience=20,
+    arch=DEFAULT_ARCH,
+):
+    rank, world_size = setup_distributed()
+    model = build(arch).to(device)
     model.train()
-    logger.info("Train: Init model")
+    logger.info(
+        f"Train: Init {arch} model "
+        f"({sum(p.numel() for p in model.parameters())} parameters) "
+        f"on rank {rank}/{world_size}"
+    )
+    # Other architectures get their own files, so they never resume from or
+    # overwrite the default model's.
+    prefix = "model/" if arch == DEFAULT_ARCH else f"model/{arch}."
+    forward = model
+    if world_size > 1:
+        forward = DistributedDataParallel(
+            model, device_ids=[device.index] if device.type == "cuda" else None
+        )
+    if compile:
+        if hasattr(torch, "compile"):
+            # Keep `model` uncompiled so saved state_dict keys stay unchanged,
+            # and compile the DDP wrapper so gradients are still all-reduced.
+            forward = torch.compile(forward)
+        else:
+            logger.warning("Train: torch.compile is not available, running eager")
+    if device.type == "cuda":
+        torch.backends.cudnn.benchmark = True
+    elif precision == "fp16":
+        logger.warning("Train: fp16 autocast is for CUDA, using bf16 on CPU")
+        precision = "bf16"
+    autocast = torch.autocast(
+        device.type, dtype=PRECISIONS[precision], enabled=precision != "fp32"
+    )
+    # Only fp16 can underflow the gradients, bf16 has the range of fp32.
+    scaler = torch.amp.GradScaler(device.type, enabled=precision == "fp16")
+    logger.info(f"Train: precision {precision}, compile {compile}")
     criterion = torch.nn.CrossEntropyLoss()
     optimizer = torch.optim.Adam(model.parameters(), lr=learning_rate)
     scheduler_after = torch.optim.lr_scheduler.StepLR(
         optimizer, step_size=30, gamma=0.5
     )
+    multiplier = warmup_multiplier(world_size)
     scheduler = GradualWarmupScheduler(
-        optimizer, 8, 10, after_scheduler=scheduler_after
+        optimizer, multiplier, 10, after_scheduler=scheduler_after
+    )
+    checkpoints = CheckpointManager(
+        "model/checkpoints" if arch == DEFAULT_ARCH else f"model/checkpoints/{arch}",
+        keep=keep,
     )
+    start_epoch, state = checkpoints.load(model, optimizer, scheduler, scaler)
+    if scheduler.multiplier != multiplier:
+        # The checkpoint was written with another number of processes.
+        rescale_warmup(scheduler, optimizer, multiplier)
+    if not start_epoch and arch == DEFAULT_ARCH:
+        # Weights-only resNet_last.pkl from before full checkpoints existed
+        model.reload()
 
-    train_dataloader = get_train_data_loader()
-    loss_best = 1
-    for epoch in range(num_epochs):
-        for i, (images, labels) in enumerate(tqdm(train_dataloader)):
-            images = images.to(device)
-            labels = labels.to(device)
-            labels = labels.long()
+    train_dataloader = DevicePrefetcher(
+        get_train_data_loader(raw=True, distributed=world_size > 1)
+    )
+    logger.info(
+        f"Train: {type(train_dataloader.loader.dataset).__name__} with "
+        f"{train_dataloader.loader.num_workers} workers on {device}"
+    )
+    # Only rank 0 evaluates and writes checkpoints, the others follow its lead.
+    if rank == 0:
+        valid_dataloader = get_evaluate_data_loader("data/valid")
+    accuracy_best = state.get("accuracy_best", -1)
+    stale_epochs = state.get("stale_epochs", 0)
+    train_start = time.perf_counter()
+    target_reached = False
+    for epoch in range(start_epoch, num_epochs):
+        start = time.perf_counter()
+        samples = correct = 0
+        set_epoch(train_dataloader.loader, epoch)
+        for i, (images, labels) in enumerate(tqdm(train_dataloader, disable=rank != 0)):
             label1, label2 = labels[:, 0], labels[:, 1]
+            samples += labels.size(0)
 
             optimizer.zero_grad()
-            y1, y2 = model(images)
-            loss1, loss2 = criterion(y1, label1), criterion(y2, label2)
-            loss = loss1 + loss2
+            with autocast:
+                outputs = forward(images)
+                if getattr(model, "ctc", False):
+                    loss = model.loss(outputs, labels)
+                    y1, y2 = model.heads(outputs.detach())
+                else:
+                    y1, y2 = outputs
+                    loss1, loss2 = criterion(y1, label1), criterion(y2, label2)
+                    loss = loss1 + loss2
             # outputs = model(images)
             # loss = criterion(outputs, labels)
-            loss.backward()
-            optimizer.step()
+            scaler.scale(loss).backward()
+            scaler.step(optimizer)
+            scaler.update()
+            correct += (
+                ((y1.argmax(dim=1) == label1) & (y2.argmax(dim=1) == label2))
+                .sum()
+                .item()
+            )
         scheduler.step()
-        logger.info(f"epoch: {epoch}, step: {i}, loss: {loss.item()}")
-        model.save()
-        if loss_best > loss.item():
-            loss_best = loss.item()
-            torch.save(model.state_dict(), "model/best.pkl")
-            logger.info("Train: Saved best model")
-    torch.save(model.state_dict(), "model/final.pkl")
-    logger.info("Train: Saved last model")
+        elapsed = time.perf_counter() - start
+        if rank == 0:
+            evaluate_start = time.perf_counter()
+            accuracy = evaluate(model, valid_dataloader)
+            logger.info(
+                f"epoch: {epoch}, step: {i}, loss: {loss.item()}, "
+                f"train accuracy: {100 * correct / samples:.2f}%, "
+                f"valid accuracy: {accuracy:.2f}%, time: {elapsed:.1f}s, "
+                f"{samples * world_size / elapsed:.0f} samples/s, "
+                f"eval: {time.perf_counter() - evaluate_start:.1f}s"
+            )
+        if world_size > 1:
+            accuracy = broadcast(accuracy if rank == 0 else 0.0)
+        if rank == 0 and not target_reached and accuracy >= target_accuracy:
+            target_reached = True
+            logger.info(
+                f"Train: Reached {target_accuracy}% accuracy after epoch {epoch} "
+                f"in {time.perf_counter() - train_start:.1f}s"
+            )
+        if accuracy > accuracy_best:
+            accuracy_best, stale_epochs = accuracy, 0
+        else:
+            stale_epochs += 1
+        if rank == 0:
+            blocked = 0
+            if not stale_epochs:
+                blocked += checkpoints.save_weights(model, f"{prefix}best.pkl")
+                logger.info(f"Train: Saved best model ({accuracy:.2f}%)")
+            blocked += checkpoints.save(
+                epoch,
+                model,
+                optimizer,
+                scheduler,
+                scaler,
+                accuracy_best=accuracy_best,
+                stale_epochs=stale_epochs,
+            )
+            logger.info(f"Train: Blocked {blocked:.3f}s on checkpoint I/O")
+        if patience and stale_epochs >= patience:
+            logger.info(f"Train: No improvement for {patience} epochs, stopping early")
+            break
+    if rank == 0:
+        checkpoints.save_weights(model, f"{prefix}final.pkl")
+        checkpoints.wait()
+        logger.info("Train: Saved last model")
+    if world_size > 1:
+        dist.destroy_process_group()
 
 
 if __name__ == "__main__":
-    main()
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--precision", choices=PRECISIONS, default="fp32")
+    parser.add_argument(
+        "--arch",
+        choices=ARCHITECTURES,
+        default=DEFAULT_ARCH,
+        help=f"saved as model/<arch>.best.pkl unless {DEFAULT_ARCH}",
+    )
+    parser.add_argument(
+        "--compile", action="store_true", help="wrap the model with torch.compile"
+    )
+    parser.add_argument("--target-accuracy", type=float, default=99.0)
+    parser.add_argument(
+        "--keep", type=int, default=3, help="number of full checkpoints to keep"
+    )
+    parser.add_argument(
+        "--patience",
+        type=int,
+        default=20,
+        help="stop after this many epochs without a better valid accuracy, 0 never",
+    )
+    args = parser.parse_args()
+    main(
+        args.precision,
+        args.compile,
+        args.target_accuracy,
+        args.keep,
+        args.patience,
+        args.arch,
+    )
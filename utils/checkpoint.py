@@ -0,0 +1,124 @@
+import glob
+import os
+import random
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import torch
+
+from utils.utils import logger
+
+
+def to_cpu(obj):
+    # Snapshot of a (nested) state dict that training can't mutate any more.
+    if isinstance(obj, torch.Tensor):
+        return obj.detach().to("cpu", copy=True)
+    if isinstance(obj, dict):
+        return {key: to_cpu(value) for key, value in obj.items()}
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(to_cpu(value) for value in obj)
+    return obj
+
+
+def get_rng_state():
+    state = {
+        "torch": torch.get_rng_state(),
+        "numpy": np.random.get_state(),
+        "random": random.getstate(),
+    }
+    if torch.cuda.is_available():
+        state["cuda"] = torch.cuda.get_rng_state_all()
+    return state
+
+
+def set_rng_state(state):
+    torch.set_rng_state(state["torch"])
+    np.random.set_state(state["numpy"])
+    random.setstate(state["random"])
+    if "cuda" in state and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all(state["cuda"])
+
+
+class CheckpointManager:
+    """Writes full training state on a background thread.
+
+    The caller only blocks while the state is copied to CPU memory (and, if
+    the disk is slower than an epoch, on the previous full checkpoint). Files are
+    written to a temporary name and renamed, so a crash never leaves a
+    truncated checkpoint behind, and only the last `keep` are kept.
+    """
+
+    def __init__(self, folder="model/checkpoints", keep=3):
+        self.folder = folder
+        self.keep = keep
+        self.executor = ThreadPoolExecutor(1, thread_name_prefix="Checkpoint")
+        self.pending = []
+        os.makedirs(folder, exist_ok=True)
+
+    def checkpoints(self):
+        return sorted(glob.glob(os.path.join(self.folder, "epoch_*.pt")))
+
+    def wait(self, kind=None):
+        # Waits for the writes of `kind` ("checkpoint" or "weights"), or all,
+        # and raises the errors of any finished write.
+        pending = []
+        for future, future_kind in self.pending:
+            if kind in (None, future_kind) or future.done():
+                future.result()
+            else:
+                pending.append((future, future_kind))
+        self.pending = pending
+
+    def write(self, state, path, prune=False):
+        tmp = f"{path}.tmp"
+        torch.save(state, tmp)
+        os.replace(tmp, path)
+        if prune:
+            for old in self.checkpoints()[: -self.keep]:
+                os.remove(old)
+
+    def submit(self, state, path, prune=False, kind="weights"):
+        future = self.executor.submit(self.write, state, path, prune)
+        self.pending.append((future, kind))
+
+    def save(self, epoch, model, optimizer, scheduler, scaler=None, **extra):
+        start = time.perf_counter()
+        # Only the previous full checkpoint, weights submitted just before
+        # (e.g. best.pkl) keep being written while the next epoch runs.
+        self.wait("checkpoint")
+        state = {
+            "epoch": epoch,
+            "model": to_cpu(model.state_dict()),
+            "optimizer": to_cpu(optimizer.state_dict()),
+            "scheduler": scheduler.state_dict(),
+            "scaler": scaler.state_dict() if scaler else None,
+            "rng": get_rng_state(),
+            "extra": extra,
+        }
+        path = os.path.join(self.folder, f"epoch_{epoch:03d}.pt")
+        self.submit(state, path, prune=True, kind="checkpoint")
+        return time.perf_counter() - start
+
+    def save_weights(self, model, path):
+        start = time.perf_counter()
+        self.submit(to_cpu(model.state_dict()), path)
+        return time.perf_counter() - start
+
+    def load(self, model, optimizer, scheduler, scaler=None):
+        """Restores the latest checkpoint.
+
+        Returns the epoch to continue from and the extra values passed to save().
+        """
+        checkpoints = self.checkpoints()
+        if not checkpoints:
+            return 0, {}
+        state = torch.load(checkpoints[-1], map_location="cpu", weights_only=False)
+        model.load_state_dict(state["model"])
+        optimizer.load_state_dict(state["optimizer"])
+        scheduler.load_state_dict(state["scheduler"])
+        if scaler and state["scaler"]:
+            scaler.load_state_dict(state["scaler"])
+        set_rng_state(state["rng"])
+        logger.info(f"Checkpoint: Resumed from {checkpoints[-1]}")
+        return state["epoch"] + 1, state["extra"]
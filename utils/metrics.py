@@ -0,0 +1,261 @@
+import asyncio
+import bisect
+import collections
+import json
+import logging
+import threading
+import time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from utils.utils import logger
+
+# Set by json_logs(): stage timers also log one structured event each.
+events = False
+
+
+class Registry:
+    """Every metric by name, rendered in the Prometheus text format."""
+
+    def __init__(self):
+        self.metrics = {}
+        self.lock = threading.Lock()
+
+    def register(self, metric):
+        # A metric created again (e.g. a new predictor) replaces the old one.
+        with self.lock:
+            self.metrics[metric.name] = metric
+        return metric
+
+    def expose(self):
+        with self.lock:
+            metrics = list(self.metrics.values())
+        return "".join(metric.expose() for metric in metrics)
+
+    def snapshot(self):
+        with self.lock:
+            metrics = list(self.metrics.values())
+        return {metric.name: metric.snapshot() for metric in metrics}
+
+
+REGISTRY = Registry()
+
+
+def header(name, kind, help):
+    return (f"# HELP {name} {help}\n" if help else "") + f"# TYPE {name} {kind}\n"
+
+
+class Histogram:
+    def __init__(self, name, buckets, help="", registry=REGISTRY):
+        self.name = name
+        self.help = help
+        self.buckets = tuple(sorted(buckets))
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.lock = threading.Lock()
+        if registry:
+            registry.register(self)
+
+    def observe(self, value):
+        with self.lock:
+            self.counts[bisect.bisect_left(self.buckets, value)] += 1
+            self.count += 1
+            self.sum += value
+
+    def samples(self, labels=""):
+        with self.lock:
+            counts, count, total = list(self.counts), self.count, self.sum
+        lines, cumulative = [], 0
+        for bucket, n in zip(self.buckets, counts):
+            cumulative += n
+            lines.append(f'{self.name}_bucket{{{labels}le="{bucket}"}} {cumulative}\n')
+        lines.append(f'{self.name}_bucket{{{labels}le="+Inf"}} {count}\n')
+        labels = f"{{{labels.rstrip(',')}}}" if labels else ""
+        lines.append(f"{self.name}_sum{labels} {total}\n")
+        lines.append(f"{self.name}_count{labels} {count}\n")
+        return "".join(lines)
+
+    def expose(self):
+        return header(self.name, "histogram", self.help) + self.samples()
+
+    def snapshot(self):
+        with self.lock:
+            return {"count": self.count, "sum": self.sum}
+
+    def summary(self):
+        with self.lock:
+            if not self.count:
+                return f"{self.name}: empty"
+            bins = [f"<={b}: {c}" for b, c in zip(self.buckets, self.counts)]
+            bins.append(f">{self.buckets[-1]}: {self.counts[-1]}")
+            return (
+                f"{self.name}: count={self.count}, mean={self.sum / self.count:.4g}, "
+                + ", ".join(bins)
+            )
+
+
+class Counter:
+    """Counts events, split by the value of one label, e.g. outcome="network"."""
+
+    def __init__(self, name, label, help="", registry=REGISTRY):
+        self.name = name
+        self.label = label
+        self.help = help
+        self.values = collections.Counter()
+        self.lock = threading.Lock()
+        if registry:
+            registry.register(self)
+
+    def inc(self, value, n=1):
+        with self.lock:
+            self.values[value] += n
+
+    def snapshot(self):
+        with self.lock:
+            return dict(self.values)
+
+    def expose(self):
+        return header(self.name, "counter", self.help) + "".join(
+            f'{self.name}{{{self.label}="{value}"}} {n}\n'
+            for value, n in sorted(self.snapshot().items())
+        )
+
+    def summary(self):
+        counts = ", ".join(f"{k}={v}" for k, v in sorted(self.snapshot().items()))
+        return f"{self.name}: {counts or 'empty'}"
+
+
+class Stages:
+    """One histogram per stage of a job, exposed as one metric with a stage label."""
+
+    def __init__(self, name, buckets, help="", registry=REGISTRY):
+        self.name = name
+        self.help = help
+        self.buckets = buckets
+        self.histograms = {}
+        self.lock = threading.Lock()
+        if registry:
+            registry.register(self)
+
+    def observe(self, stage, value):
+        histogram = self.histograms.get(stage)
+        if histogram is None:
+            with self.lock:
+                histogram = self.histograms.setdefault(
+                    stage, Histogram(self.name, self.buckets, registry=None)
+                )
+        histogram.observe(value)
+
+    @contextmanager
+    def time(self, stage, **fields):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            seconds = time.perf_counter() - start
+            self.observe(stage, seconds)
+            if events:
+                logger.info(
+                    f"Stage: {stage} {seconds:.3f}s",
+                    extra={"stage": stage, "seconds": seconds, **fields},
+                )
+
+    def expose(self):
+        with self.lock:
+            histograms = sorted(self.histograms.items())
+        return header(self.name, "histogram", self.help) + "".join(
+            histogram.samples(f'stage="{stage}",') for stage, histogram in histograms
+        )
+
+    def snapshot(self):
+        with self.lock:
+            histograms = sorted(self.histograms.items())
+        return {stage: histogram.snapshot() for stage, histogram in histograms}
+
+    def summary(self):
+        stages = [
+            f"{stage} {value['count']}x {value['sum'] / value['count']:.3f}s"
+            for stage, value in self.snapshot().items()
+            if value["count"]
+        ]
+        return f"{self.name}: {', '.join(stages) or 'empty'}"
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        if self.path.split("?")[0] != "/metrics":
+            self.send_error(404)
+            return
+        body = self.server.registry.expose().encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+def serve(port, address="127.0.0.1", registry=REGISTRY):
+    """Serves /metrics for Prometheus from a daemon thread."""
+    server = ThreadingHTTPServer((address, port), MetricsHandler)
+    server.daemon_threads = True
+    server.registry = registry
+    threading.Thread(target=server.serve_forever, name="Metrics", daemon=True).start()
+    logger.info(f"Metrics: Serving http://{address}:{server.server_address[1]}/metrics")
+    return server
+
+
+# Attributes every LogRecord has, anything else was passed with extra=.
+RECORD_FIELDS = set(vars(logging.makeLogRecord({}))) | {"message", "asctime"}
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {
+            "time": self.formatTime(record),
+            "level": record.levelname,
+            "file": record.filename,
+            "message": record.getMessage(),
+        }
+        entry.update(
+            (key, value)
+            for key, value in vars(record).items()
+            if key not in RECORD_FIELDS
+        )
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+def json_logs():
+    """Logs one JSON object per line, including an event per timed stage."""
+    global events
+    events = True
+    for handler in logging.getLogger().handlers:
+        handler.setFormatter(JsonFormatter())
+
+
+def configure(config):
+    """Applies the METRICS_PORT and LOG_FORMAT keys of a daemon's config."""
+    if config.get("LOG_FORMAT") == "json":
+        json_logs()
+    if config.get("METRICS_PORT"):
+        return serve(config["METRICS_PORT"])
+
+
+def percentile(values, q):
+    values = sorted(values)
+    if not values:
+        return float("nan")
+    return values[min(len(values) - 1, int(len(values) * q / 100))]
+
+
+async def monitor_loop_lag(histogram, interval=0.1):
+    # A coroutine that oversleeps is one the event loop could not get back to.
+    while True:
+        start = time.perf_counter()
+        await asyncio.sleep(interval)
+        histogram.observe(time.perf_counter() - start - interval)
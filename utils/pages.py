@@ -0,0 +1,52 @@
+import html
+import re
+
+# Targeted extraction from the dk/CAS pages: scan the raw bytes for the one
+# tag we need and stop there, instead of building a whole BeautifulSoup tree.
+# A ">" inside a quoted attribute value doesn't end the tag.
+INSIDE = rb"""(?:"[^"]*"|'[^']*'|[^'">])*"""
+TAG = re.compile(rb"<(input|div)\b(" + INSIDE + rb")>", re.I)
+DIV = re.compile(rb"<(/?)div\b" + INSIDE + rb">", re.I)
+ATTRIBUTE = re.compile(rb"""([\w:-]+)\s*=\s*(?:"([^"]*)"|'([^']*)'|([^\s"'>]+))""")
+
+
+def attributes(tag):
+    return {
+        match.group(1).lower(): match.group(2)
+        or match.group(3)
+        or match.group(4)
+        or b""
+        for match in ATTRIBUTE.finditer(tag)
+    }
+
+
+def find_execution(content):
+    """Value of the hidden `execution` input of the CAS login form, or None."""
+    for match in TAG.finditer(content):
+        if match.group(1).lower() != b"input":
+            continue
+        attrs = attributes(match.group(2))
+        if attrs.get(b"name") == b"execution" and attrs.get(b"type") == b"hidden":
+            # Decoded like BeautifulSoup does, the form expects the plain value.
+            return html.unescape(attrs.get(b"value", b"").decode())
+    return None
+
+
+def first_form_group(content):
+    """Raw HTML of the first div with class form-group, or None."""
+    for match in TAG.finditer(content):
+        if match.group(1).lower() != b"div":
+            continue
+        if b"form-group" not in attributes(match.group(2)).get(b"class", b"").split():
+            continue
+        depth = 0
+        for div in DIV.finditer(content, match.start()):
+            depth += -1 if div.group(1) else 1
+            if not depth:
+                return content[match.start() : div.end()]
+        return content[match.start() :]
+    return None
+
+
+def checked_in(content):
+    return b"success" in (first_form_group(content) or b"")
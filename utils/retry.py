@@ -0,0 +1,184 @@
+import asyncio
+import random
+import threading
+import time
+
+from utils.metrics import Counter
+from utils.utils import logger
+
+
+class WrongCaptcha(Exception):
+    pass
+
+
+class CheckinFailed(Exception):
+    pass
+
+
+class ServerError(Exception):
+    pass
+
+
+class GiveUp(Exception):
+    """Raised by RetryPolicy when it stops retrying, with the last error's class."""
+
+    def __init__(self, kind, error=None):
+        super().__init__(f"{kind}: {error!r}" if error else kind)
+        self.kind = kind
+
+
+def check_status(response):
+    # Works for both httpx and requests responses.
+    if response.status_code >= 500:
+        raise ServerError(f"{response.status_code} from {response.url}")
+    return response
+
+
+class CircuitBreaker:
+    """Stops all jobs from calling an upstream that keeps failing.
+
+    After `threshold` network or server errors in a row the circuit opens
+    and every call is refused for `cooldown` seconds. Then a single call is
+    let through: success closes the circuit, another failure reopens it.
+    """
+
+    def __init__(self, threshold=10, cooldown=60):
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.failures = 0
+        self.opened = None
+        self.lock = threading.Lock()
+
+    def allow(self):
+        with self.lock:
+            if self.opened is None:
+                return True
+            if time.monotonic() - self.opened < self.cooldown:
+                return False
+            # Half open: the next caller is the probe, everyone else waits.
+            self.opened = time.monotonic()
+            return True
+
+    def remaining(self):
+        """Seconds until the open circuit lets a call through again, 0 if closed."""
+        with self.lock:
+            if self.opened is None:
+                return 0
+            return max(0.0, self.cooldown - (time.monotonic() - self.opened))
+
+    def success(self):
+        with self.lock:
+            if self.opened is not None:
+                logger.info("Retry: Upstream is back, closing the circuit")
+            self.failures = 0
+            self.opened = None
+
+    def failure(self):
+        with self.lock:
+            self.failures += 1
+            if self.failures >= self.threshold and self.opened is None:
+                logger.warning(
+                    f"Retry: {self.failures} upstream errors in a row, "
+                    f"opening the circuit for {self.cooldown}s"
+                )
+            if self.failures >= self.threshold:
+                self.opened = time.monotonic()
+
+
+class RetryPolicy:
+    """Runs one login or check-in step with retries.
+
+    Each attempt gets `timeout` seconds. Errors are classified as
+    wrong_captcha and checkin_failed (retried at once, the upstream is
+    fine), network and server_error (retried after an exponential backoff
+    with full jitter, and counted by the circuit breaker) or error
+    (anything else, not retried). Every outcome is counted per class in
+    `counts`.
+    """
+
+    def __init__(
+        self,
+        attempts=5,
+        timeout=30,
+        base=1,
+        cap=30,
+        breaker=None,
+        network_errors=(OSError,),
+    ):
+        self.attempts = attempts
+        self.timeout = timeout
+        self.base = base
+        self.cap = cap
+        self.breaker = breaker or CircuitBreaker()
+        self.network_errors = tuple(network_errors)
+        self.counts = Counter(
+            "checkin_attempts_total", "outcome", "Login/check-in attempts by outcome"
+        )
+
+    def count(self, kind):
+        self.counts.inc(kind)
+
+    def classify(self, error):
+        if isinstance(error, WrongCaptcha):
+            return "wrong_captcha"
+        if isinstance(error, CheckinFailed):
+            return "checkin_failed"
+        if isinstance(error, ServerError):
+            return "server_error"
+        if isinstance(error, (asyncio.TimeoutError, *self.network_errors)):
+            return "network"
+        return "error"
+
+    def delay(self, attempt):
+        return random.uniform(0, min(self.cap, self.base * 2**attempt))
+
+    def before(self):
+        if not self.breaker.allow():
+            self.count("circuit_open")
+            raise GiveUp("circuit_open")
+
+    def after(self, attempt, error):
+        """Counts the outcome of an attempt, returns how long to wait before the next."""
+        if error is None:
+            self.count("success")
+            self.breaker.success()
+            return None
+        kind = self.classify(error)
+        self.count(kind)
+        if kind in ("network", "server_error"):
+            self.breaker.failure()
+        else:
+            self.breaker.success()
+        if kind == "error" or attempt == self.attempts - 1:
+            raise GiveUp(kind, error) from error
+        logger.warning(f"Retry: {kind} on attempt {attempt}: {error!r}")
+        return self.delay(attempt) if kind in ("network", "server_error") else 0
+
+    async def run_async(self, function, *args):
+        for attempt in range(self.attempts):
+            self.before()
+            try:
+                result = await asyncio.wait_for(function(*args), self.timeout)
+            except Exception as e:
+                await asyncio.sleep(self.after(attempt, e))
+            else:
+                self.after(attempt, None)
+                return result
+
+    def run(self, function, *args):
+        # Per-attempt timeouts are up to `function`, e.g. requests' timeout=.
+        for attempt in range(self.attempts):
+            self.before()
+            try:
+                result = function(*args)
+            except Exception as e:
+                time.sleep(self.after(attempt, e))
+            else:
+                self.after(attempt, None)
+                return result
+
+    def summary(self):
+        counts = ", ".join(
+            f"{k}={v}" for k, v in sorted(self.counts.snapshot().items())
+        )
+        return f"retry: {counts or 'empty'}"
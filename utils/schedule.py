@@ -0,0 +1,111 @@
+import argparse
+import datetime
+import math
+import random
+from collections import Counter
+
+from utils.utils import logger
+
+WINDOW_START = datetime.time(0, 2)
+WINDOW_MINUTES = 58
+PER_MINUTE = 30
+WARM_UP_MINUTES = 5  # load the captcha model this long before the window
+
+
+def spread(
+    usernames,
+    failed=(),
+    start=WINDOW_START,
+    minutes=WINDOW_MINUTES,
+    per_minute=PER_MINUTE,
+):
+    """Evenly spaced check-in times for `usernames`, as {username: datetime.time}.
+
+    The accounts in `failed` get the earliest slots, so they have the most
+    time left for retries. The window starts at `start` and is `minutes`
+    long, it is stretched if that would put more than `per_minute` accounts
+    in a minute.
+    """
+    failed = set(failed)
+    usernames = sorted(
+        usernames, key=lambda username: (username not in failed, username)
+    )
+    if not usernames:
+        return {}
+    needed = math.ceil(len(usernames) / per_minute)
+    if needed > minutes:
+        logger.warning(
+            f"Schedule: {len(usernames)} accounts at {per_minute}/min "
+            f"need {needed} minutes, stretching the window"
+        )
+        minutes = needed
+    step = 60 * minutes / len(usernames)
+    origin = datetime.datetime.combine(datetime.date.today(), start)
+    return {
+        username: (origin + datetime.timedelta(seconds=i * step)).time()
+        for i, username in enumerate(usernames)
+    }
+
+
+def window(config):
+    """spread() keyword arguments from the SCHEDULE_* settings of config.json."""
+    return {
+        "start": datetime.time.fromisoformat(config.get("SCHEDULE_START", "00:02")),
+        "minutes": config.get("SCHEDULE_MINUTES", WINDOW_MINUTES),
+        "per_minute": config.get("PER_MINUTE", PER_MINUTE),
+    }
+
+
+def deadline(window, now=None):
+    """End of the window() that is running at `now`, as a datetime."""
+    now = now or datetime.datetime.now()
+    start = datetime.datetime.combine(now.date(), window["start"])
+    if start > now:
+        start -= datetime.timedelta(days=1)  # started before midnight
+    return start + datetime.timedelta(minutes=window["minutes"])
+
+
+def before(start, minutes=10):
+    origin = datetime.datetime.combine(datetime.date.today(), start)
+    return (origin - datetime.timedelta(minutes=minutes)).time()
+
+
+def by_minute(times):
+    """Groups a spread() result into {(hour, minute): [usernames]}."""
+    groups = {}
+    for username, at in times.items():
+        groups.setdefault((at.hour, at.minute), []).append(username)
+    return groups
+
+
+def load_histogram(times):
+    counts = Counter((at.hour, at.minute) for at in times)
+    width = max(counts.values(), default=0)
+    return "\n".join(
+        f"{hour:02d}:{minute:02d} {count:5d} {'#' * round(50 * count / width)}"
+        for (hour, minute), count in sorted(counts.items())
+    )
+
+
+def main():
+    # Simulation: python -m utils.schedule --accounts 3000 --failed 0.05
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--accounts", type=int, default=1000)
+    parser.add_argument("--failed", type=float, default=0.05, help="share failed")
+    parser.add_argument("--minutes", type=int, default=WINDOW_MINUTES)
+    parser.add_argument("--per-minute", type=int, default=PER_MINUTE)
+    args = parser.parse_args()
+
+    usernames = [f"2017{i:08d}" for i in range(args.accounts)]
+    failed = random.sample(usernames, int(args.failed * args.accounts))
+    # The old scheme: account i at 00:(2 + i), capped at 00:59.
+    old = [datetime.time(0, min(2 + i, 59)) for i in range(args.accounts)]
+    new = spread(usernames, failed, minutes=args.minutes, per_minute=args.per_minute)
+    print(f"Before (minute=2+i):\n{load_histogram(old)}\n")
+    print(f"After (spread):\n{load_histogram(new.values())}")
+    last_failed = max((new[username] for username in failed), default=None)
+    logger.info(f"Schedule: {len(failed)} failed accounts all start by {last_failed}")
+
+
+if __name__ == "__main__":
+    main()
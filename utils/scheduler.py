@@ -25,6 +25,20 @@ class GradualWarmupScheduler(_LRScheduler):
         self.finished = False
         super(GradualWarmupScheduler, self).__init__(optimizer)
 
+    def state_dict(self):
+        # after_scheduler holds a reference to the optimizer, store its own state instead
+        state = {key: value for key, value in self.__dict__.items() if key not in ('optimizer', 'after_scheduler')}
+        if self.after_scheduler:
+            state['after_scheduler'] = self.after_scheduler.state_dict()
+        return state
+
+    def load_state_dict(self, state_dict):
+        state_dict = dict(state_dict)
+        after_scheduler = state_dict.pop('after_scheduler', None)
+        self.__dict__.update(state_dict)
+        if after_scheduler is not None:
+            self.after_scheduler.load_state_dict(after_scheduler)
+
     def get_lr(self):
         if self.last_epoch > self.total_epoch:
             if self.after_scheduler:
@@ -0,0 +1,133 @@
+import hashlib
+import json
+import os
+import threading
+import time
+from http.cookiejar import Cookie
+
+from utils.utils import logger
+
+SESSION_DIR = "sessions"
+SESSION_TTL = 36 * 3600  # seconds, past the daily check-in 24h later
+MAX_SESSIONS = 10000
+
+
+def dump_cookies(jar):
+    return [
+        {
+            "name": cookie.name,
+            "value": cookie.value,
+            "domain": cookie.domain,
+            "path": cookie.path,
+            "secure": cookie.secure,
+            "expires": cookie.expires,
+        }
+        for cookie in jar
+    ]
+
+
+def make_cookie(name, value, domain, path, secure, expires):
+    return Cookie(
+        version=0,
+        name=name,
+        value=value,
+        port=None,
+        port_specified=False,
+        domain=domain,
+        domain_specified=domain.startswith("."),
+        domain_initial_dot=domain.startswith("."),
+        path=path,
+        path_specified=True,
+        secure=secure,
+        expires=expires,
+        discard=expires is None,
+        comment=None,
+        comment_url=None,
+        rest={},
+    )
+
+
+class SessionStore:
+    """Cookies of logged in accounts, one JSON file per username.
+
+    Works with any http.cookiejar.CookieJar, so with both
+    `httpx.AsyncClient().cookies.jar` and `requests.Session().cookies`.
+    Sessions older than `ttl` seconds are dropped when read, and past
+    `max_sessions` files the least recently saved ones are evicted. Files are
+    written to a temporary name and renamed, so concurrent jobs (threads or
+    processes) only ever see a whole session.
+    """
+
+    def __init__(self, folder=SESSION_DIR, ttl=SESSION_TTL, max_sessions=MAX_SESSIONS):
+        self.folder = folder
+        self.ttl = ttl
+        self.max_sessions = max_sessions
+        self.lock = threading.Lock()
+        os.makedirs(folder, mode=0o700, exist_ok=True)
+        # Kept up to date by save() and delete() so the folder is only
+        # scanned again once there are more than max_sessions files.
+        self.count = len(self.files())
+
+    def path(self, username):
+        digest = hashlib.sha1(str(username).encode()).hexdigest()
+        return os.path.join(self.folder, f"{digest}.json")
+
+    def load(self, username, jar):
+        """Adds the stored cookies of `username` to `jar`, True if there were any."""
+        path = self.path(username)
+        try:
+            with open(path, "r") as file:
+                session = json.load(file)
+            saved, cookies = session["saved"], session["cookies"]
+        except (FileNotFoundError, ValueError, KeyError, TypeError):
+            return False
+        if time.time() - saved > self.ttl:
+            self.delete(username)
+            return False
+        for cookie in cookies:
+            jar.set_cookie(make_cookie(**cookie))
+        logger.info(f"Session: {username} Restored {len(cookies)} cookies")
+        return True
+
+    def save(self, username, jar):
+        path = self.path(username)
+        tmp = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(
+            os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600), "w"
+        ) as file:
+            json.dump({"saved": time.time(), "cookies": dump_cookies(jar)}, file)
+        new = not os.path.exists(path)
+        os.replace(tmp, path)
+        if new:
+            with self.lock:
+                self.count += 1
+                full = self.count > self.max_sessions
+            if full:
+                self.evict()
+
+    def delete(self, username):
+        try:
+            os.remove(self.path(username))
+        except FileNotFoundError:
+            return
+        with self.lock:
+            self.count -= 1
+
+    def files(self):
+        return [
+            entry for entry in os.scandir(self.folder) if entry.name.endswith(".json")
+        ]
+
+    def evict(self):
+        with self.lock:
+            files = self.files()
+            self.count = len(files)
+            if len(files) <= self.max_sessions:
+                return
+            files.sort(key=lambda entry: entry.stat().st_mtime)
+            for entry in files[: len(files) - self.max_sessions]:
+                try:
+                    os.remove(entry.path)
+                except FileNotFoundError:
+                    continue
+                self.count -= 1
@@ -0,0 +1,100 @@
+import datetime
+import os
+import sqlite3
+import threading
+import time
+
+STORE_PATH = "accounts.db"
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS accounts (
+    username TEXT PRIMARY KEY,
+    password TEXT NOT NULL,
+    region INTEGER NOT NULL DEFAULT 1,
+    chat INTEGER,
+    time TEXT NOT NULL,
+    last_run REAL,
+    last_result INTEGER
+);
+CREATE INDEX IF NOT EXISTS accounts_chat ON accounts (chat);
+"""
+
+
+class AccountStore:
+    """Accounts of the bot with their daily check-in time and last result.
+
+    A single SQLite file in WAL mode, so a crash loses at most the last
+    commit and bot commands never wait on a check-in being recorded.
+    Lookups by username and by chat are indexed. Rows are dicts with the
+    keys the job context uses (username, password, region, chat) plus time,
+    last_run and last_result.
+    """
+
+    def __init__(self, path=STORE_PATH):
+        if path != ":memory:" and not os.path.exists(path):
+            os.close(os.open(path, os.O_WRONLY | os.O_CREAT, 0o600))
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.row_factory = sqlite3.Row
+        self.lock = threading.Lock()
+        with self.lock, self.db:
+            self.db.execute("PRAGMA journal_mode=WAL")
+            self.db.execute("PRAGMA synchronous=NORMAL")
+            self.db.executescript(SCHEMA)
+
+    def query(self, sql, *args):
+        with self.lock:
+            return [dict(row) for row in self.db.execute(sql, args)]
+
+    def add(self, username, password, region, chat, at):
+        self.add_many([(username, password, region, chat, at)])
+
+    def add_many(self, accounts):
+        """Inserts or updates (username, password, region, chat, datetime.time) rows."""
+        with self.lock, self.db:
+            self.db.executemany(
+                "INSERT INTO accounts (username, password, region, chat, time) "
+                "VALUES (?, ?, ?, ?, ?) ON CONFLICT (username) DO UPDATE SET "
+                "password = excluded.password, region = excluded.region, "
+                "chat = excluded.chat, time = excluded.time",
+                [
+                    (username, password, int(region), chat, at.isoformat())
+                    for username, password, region, chat, at in accounts
+                ],
+            )
+
+    def set_times(self, times):
+        """Moves accounts to new daily times, from {username: datetime.time}."""
+        with self.lock, self.db:
+            self.db.executemany(
+                "UPDATE accounts SET time = ? WHERE username = ?",
+                [(at.isoformat(), username) for username, at in times.items()],
+            )
+
+    def delete(self, username):
+        with self.lock, self.db:
+            self.db.execute("DELETE FROM accounts WHERE username = ?", (username,))
+
+    def record(self, username, result):
+        with self.lock, self.db:
+            self.db.execute(
+                "UPDATE accounts SET last_run = ?, last_result = ? WHERE username = ?",
+                (time.time(), int(result), username),
+            )
+
+    def get(self, username):
+        rows = self.query("SELECT * FROM accounts WHERE username = ?", username)
+        return rows[0] if rows else None
+
+    def by_chat(self, chat):
+        return self.query("SELECT * FROM accounts WHERE chat = ?", chat)
+
+    def all(self):
+        return self.query("SELECT * FROM accounts")
+
+    def count(self):
+        with self.lock:
+            return self.db.execute("SELECT COUNT(*) FROM accounts").fetchone()[0]
+
+
+def daily_time(account, tz=datetime.timezone(datetime.timedelta(hours=8))):
+    return datetime.time.fromisoformat(account["time"]).replace(tzinfo=tz)
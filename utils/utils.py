@@ -1,8 +1,22 @@
-import torch
-import numpy as np
 import logging
+import os
 
-device = torch.device("cuda:0" if torch.cuda.is_available() else "cpu")
+
+def __getattr__(name):
+    # `device` imports torch on first use, so the daemons can run without it
+    # (see inference.OnnxModel).
+    if name == "device":
+        import torch
+
+        global device
+        # torchrun gives every process its own LOCAL_RANK, and so its own GPU
+        device = torch.device(
+            f"cuda:{os.environ.get('LOCAL_RANK', 0)}"
+            if torch.cuda.is_available()
+            else "cpu"
+        )
+        return device
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
 
 logging.basicConfig(
     format="%(asctime)s - %(filename)s - %(levelname)s - %(message)s", level=logging.INFO
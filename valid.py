@@ -1,32 +1,23 @@
-import numpy as np
-import torch
+import sys
 
-from dataset import get_predict_data_loader
-from model import ResidualBlock, ResNet
-from utils.utils import LabeltoStr, StrtoLabel, device, logger
+from evaluate import evaluate, get_evaluate_data_loader
+from inference import MODEL_PATH, load_model
+from utils.utils import logger
 
 
-def main():
-    model = ResNet(ResidualBlock)
-    model.eval()
-    model.load_state_dict(torch.load("model/best.pkl", map_location=device))
+def main(path=MODEL_PATH):
+    model = load_model(path)
     logger.info("Valid: loaded model")
 
-    predict_dataloader = get_predict_data_loader()
+    predict_dataloader = get_evaluate_data_loader("data/valid")
 
-    for i, (images, labels) in enumerate(predict_dataloader):
-        predict_label1, predict_label2 = model(images)
-        predict_label = LabeltoStr(
-            [
-                np.argmax(predict_label1.data.numpy()[0]),
-                np.argmax(predict_label2.data.numpy()[0]),
-            ]
-        )
-        true_label = LabeltoStr(labels.data.numpy()[0])
+    accuracy, results = evaluate(model, predict_dataloader, details=True)
+    for i, (true_label, predict_label) in enumerate(results):
         logger.info(
             f"Test: {i}, Expect: {true_label}, Predict: {predict_label}, Result: {True if true_label == predict_label else False}"
         )
+    logger.info(f"Valid finished! Accuracy: {accuracy}%")
 
 
 if __name__ == "__main__":
-    main()
+    main(*sys.argv[1:2])